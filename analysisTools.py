@@ -1,5 +1,8 @@
 # tools for trajectory analysis
-from utils import printRecord
+from utils import printRecord, fileLock
+import os
+import json
+import hashlib
 import numpy as np
 import MDAnalysis as mda
 from MDAnalysis.analysis import distances
@@ -8,8 +11,7 @@ import scipy.spatial as spatial
 import sklearn.cluster as cluster
 from sklearn.decomposition import PCA
 from MDAnalysis.analysis.base import AnalysisBase
-from MDAnalysis.lib.distances import calc_bonds
-from MDAnalysis.analysis.dihedrals import Dihedral
+from MDAnalysis.lib.distances import calc_bonds, calc_dihedrals
 from nupack import *
 from seqfold import dg, fold
 
@@ -40,89 +42,122 @@ class atomDistances(AnalysisBase):
     def _conclude(self):
         self.results = np.asarray(self.results)
 
-# noinspection PyTypeChecker
-def getBaseBaseDistTraj(u):
+def getResidueAtomPlan(residues):
+    """
+    precompute which atoms belong to which residue, to get the centers of geometry of all residues at once
+    :param residues: MDA ResidueGroup
+    :return: atoms of all residues in residue order, offset of each residue in them, number of atoms per residue
+    """
+    atoms = residues.atoms
+    counts = np.asarray([residue.atoms.n_atoms for residue in residues])
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    return atoms, offsets, counts
+
+def getResidueCentroids(positions, plan):
+    """
+    centers of geometry of all residues of a plan, with a single reduction
+    :param positions: positions of the plan's atoms for one frame (atoms x 3) or a block of frames (frames x atoms x 3)
+    :param plan: from getResidueAtomPlan
+    :return:
+    """
+    atoms, offsets, counts = plan
+    return np.add.reduceat(np.asarray(positions, dtype=float), offsets, axis=-2) / counts[:, None]
+
+def iterResidueCentroids(u, plans, start=0, chunkSize=1):
+    """
+    yield the box dimensions and the residue centroids of every plan for each frame from 'start' on
+    with chunkSize > 1, the positions of chunkSize frames are gathered and reduced at once
+    :param u: MDA universe
+    :param plans: list of residue plans from getResidueAtomPlan
+    :return:
+    """
+    positions, dimensions = [[] for plan in plans], []
+    for ts in u.trajectory[start:]:
+        dimensions.append(None if ts.dimensions is None else np.copy(ts.dimensions))
+        for positionList, plan in zip(positions, plans):
+            positionList.append(plan[0].positions)
+        if len(dimensions) == chunkSize:
+            yield from zip(dimensions, *[getResidueCentroids(positionList, plan) for positionList, plan in zip(positions, plans)])
+            positions, dimensions = [[] for plan in plans], []
+
+    if len(dimensions) > 0:
+        yield from zip(dimensions, *[getResidueCentroids(positionList, plan) for positionList, plan in zip(positions, plans)])
+
+def getBaseBaseDistTraj(u, start=0, chunkSize=1):
     """
     given an MDA universe containing ssDNA (segment 1)
     return the trajectory of all the inter-base center-of-geometry distances
+    from frame 'start' on, reading chunkSize frames at a time
     """
     nbases = u.segments[0].residues.n_residues
-    baseDists = np.zeros((len(u.trajectory), nbases, nbases))  # matrix of CoG distances
-    tt = 0
-    for ts in u.trajectory:
-        dnaResidues = u.segments[0]
-        posMat = np.zeros((nbases, 3))
-
-        for i in range(nbases):
-            posMat[i] = dnaResidues.residues[i].atoms.center_of_geometry()
-
-        baseDists[tt, :, :] = distances.distance_array(posMat, posMat, box=u.dimensions)  # fast calculation
-        tt += 1
+    baseDists = np.zeros((len(u.trajectory) - start, nbases, nbases))  # matrix of CoG distances
+    dnaPlan = getResidueAtomPlan(u.segments[0].residues)
+    for tt, (dimensions, posMat) in enumerate(iterResidueCentroids(u, [dnaPlan], start, chunkSize)):
+        baseDists[tt, :, :] = distances.distance_array(posMat, posMat, box=dimensions)  # fast calculation
 
     return baseDists
 
-def getPairTraj(wcTraj):
+def getPairTraj(wcTraj, seed=0, chunkSize=1000):
     """
     identify bases which are paired according to their WC hydrogen bond lengths
-    return the shortest hydrogen bond pair for every base over time
-    note - it's possible to have multiple bases paired to one in this algo -
-    TO-DO
-    post-processing cleanup step where we see what the next closest base is for multi-paired setups
+    every base may pair with its nearest neighbour, if it is within a hydrogen bond length and not directly adjacent
+    when several bases compete for the same partner, mutually-nearest pairs win, the others are settled in a random (seeded) order
+    this is a greedy matching, so no base is ever paired twice
+    all frames are processed at once, chunkSize at a time
+    return the partner of every base over time, indexed from 1 (0 for unpaired)
     """
     trajTime = len(wcTraj)
     seqLen = wcTraj.shape[-1]
     pairedBases = np.zeros((trajTime, seqLen)).astype(int)
-    problems = []
-    for tt in range(trajTime):
-        pairMat = wcTraj[tt] + np.eye(seqLen) * 20  # add 20 on the diagonal so it's never counted as the 'nearest neighbour' to itself
-        randomIndices = np.arange(wcTraj.shape[-1])
-        np.random.shuffle(randomIndices)
-        for i in range(wcTraj.shape[-1]): # search for the closest base
-            ind = randomIndices[i] # randomize order so that any errors are not correlated
-            nearestNeighbour = np.argmin(pairMat[ind, :])
-            if nearestNeighbour > ind: # only do the rest if the nearest neighbour is > i - ensures reciprocal algorithm will work
-                if pairedBases[tt,nearestNeighbour] == 0: # also always accept the first base and no others - may or may not be optimal but it is clean
-                    if wcTraj[tt, ind, nearestNeighbour] < 3.3:  # if we're within a hydrogen bond length, count it as a pair
-                        if np.abs(ind-nearestNeighbour) > 2: # also, we cannot pair with a bases directly adjacent
-                            pairedBases[tt, ind] = int(nearestNeighbour + 1)  # indexing from 1
-                            pairedBases[tt, nearestNeighbour] = int(ind+1) # reciprocally pair this base to base i - indexing from 1
-                            # this approach guarantees that sequences are always built from lists of pairs, with no multiple or dangling bonds
-                            # possible that we may realize suboptimal structures, but overall this is safe and simple
-                            # in principle - we could consider between different 3D configurations, e.g. which pairs are closer, but this I think should work for now
-                            # could also minimize error by shrinking the H-bond cutoff range, but we then may reduce pairing too much
-
-        # we then have to clean it, because this does not enforce that bases are mutually paired
-        pairingErrors = findPairingErrors(pairedBases[tt], tt)
-        if pairingErrors != []:
-            problems.append(pairingErrors)  # collect problems timepoint-by-timepoint
-
-    if problems != []:
-        printRecord('Encountered error in pairing algorithm!') # should not be possible, currently
+    rng = np.random.default_rng(seed)
+    bases = np.arange(seqLen)
+
+    for start in range(0, trajTime, chunkSize):
+        pairMat = wcTraj[start:start + chunkSize] + np.eye(seqLen) * 20  # add 20 on the diagonal so it's never counted as the 'nearest neighbour' to itself
+        nearest = np.argmin(pairMat, axis=2)
+        nearestDist = np.take_along_axis(pairMat, nearest[:, :, None], axis=2)[:, :, 0]
+        frames = np.repeat(np.arange(len(nearest))[:, None], seqLen, axis=1)
+
+        # candidate pair of every base with its nearest neighbour, counted once from the lower index
+        # within a hydrogen bond length, and we cannot pair with a bases directly adjacent
+        candidates = (nearest > bases) & (nearestDist < 3.3) & (np.abs(nearest - bases) > 2)
+        mutual = np.take_along_axis(nearest, nearest, axis=1) == bases
+        priority = rng.random(nearest.shape) + mutual  # mutually-nearest pairs first, the rest in random order
+
+        # greedy matching by priority: accept every candidate with the highest priority at both of its bases, until none are left
+        chunkPairs = np.zeros(nearest.shape).astype(int)
+        while candidates.any():
+            candidatePriority = np.where(candidates, priority, -1)
+            bestPriority = candidatePriority.copy()
+            np.maximum.at(bestPriority, (frames, nearest), candidatePriority)
+            accepted = candidates & (candidatePriority >= bestPriority) & (candidatePriority >= np.take_along_axis(bestPriority, nearest, axis=1))
+
+            acceptedFrames, acceptedBases = np.nonzero(accepted)
+            acceptedMates = nearest[acceptedFrames, acceptedBases]
+            chunkPairs[acceptedFrames, acceptedBases] = acceptedMates + 1  # indexing from 1
+            chunkPairs[acceptedFrames, acceptedMates] = acceptedBases + 1  # reciprocally pair this base to base i - indexing from 1
+
+            unpaired = chunkPairs == 0
+            candidates &= unpaired & np.take_along_axis(unpaired, nearest, axis=1)
+
+        pairedBases[start:start + chunkSize] = chunkPairs
 
     return pairedBases
 
-def getPepBaseDistTraj(u, peptide, sequence):
+def getPepBaseDistTraj(u, peptide, sequence, chunkSize=1):
     """
     given an MDA universe
     return distances between each peptide and each base
-    at every timepoint in the trajectory
+    at every timepoint in the trajectory, reading chunkSize frames at a time
     :return: pepNucDists - peptide-nucleicacid distances
     """
 
     pepNucDists = np.zeros((len(u.trajectory), len(peptide), len(sequence)))  # distances between peptides and nucleotiedes
-    tt = 0
-    for ts in u.trajectory:
-        analyteResidues = u.segments[1]
-        baseResidues = u.segments[0]
-        posMat1 = np.zeros((len(peptide), 3))
-        posMat2 = np.zeros((len(sequence), 3))
-        for i in range(len(peptide)):
-            posMat1[i] = analyteResidues.residues[i].atoms.center_of_geometry()
-        for i in range(len(sequence)):
-            posMat2[i] = baseResidues.residues[i].atoms.center_of_geometry()
-
-        pepNucDists[tt, :, :] = distances.distance_array(posMat1, posMat2, box=u.dimensions)
-        tt += 1
+    analytePlan = getResidueAtomPlan(u.segments[1].residues[:len(peptide)])
+    basePlan = getResidueAtomPlan(u.segments[0].residues[:len(sequence)])
+    for tt, (dimensions, posMat1, posMat2) in enumerate(iterResidueCentroids(u, [analytePlan, basePlan], chunkSize=chunkSize)):
+        pepNucDists[tt, :, :] = distances.distance_array(posMat1, posMat2, box=dimensions)
 
     return pepNucDists
 
@@ -143,90 +178,332 @@ def getPepContactTraj(pepNucDists):
 
     return contacts, np.asarray(nContacts)
 
+def getWCAtomIndices(u):
+    """
+    identify the atoms for the WC distance calculation, with a single selection per base
+    N3 of pyrimidines pairs with N1 of the other base, and N1 of purines with N3 of the other base
+    :param u:
+    :return: bond-mate 1 of each base, N1 and N3 of each base, and which bases are pyrimidines
+    """
+    n_bases = u.segments[0].residues.n_residues
+    bondMates = np.zeros(n_bases, dtype=int)
+    N1, N3 = np.zeros_like(bondMates), np.zeros_like(bondMates)
+    pyrimidines = np.zeros(n_bases, dtype=bool)
+    pyrimidine = None
+    for i in range(n_bases):
+        base = u.select_atoms(" resid {0!s} ".format(i + 1))
+        if base.resnames[0] in ["DC", "DT", "U", "C", "T", "CYT", "THY", "URA"]:
+            pyrimidine = True
+        if base.resnames[0] in ["DG", "DA", "A", "G", "ADE", "GUA"]:
+            pyrimidine = False
+        pyrimidines[i] = pyrimidine
+        N1[i] = base.ids[base.names == "N1"][0]  # atom ids are used as indices, as in mda.AtomGroup(ids, u)
+        N3[i] = base.ids[base.names == "N3"][0]
+        bondMates[i] = N3[i] if pyrimidine else N1[i]
+
+    return bondMates, N1, N3, pyrimidines
+
 def getWCDistTraj(u):
     """
-    use the atomDistances class to calculate the WC base pairing distances between all bases on a sequence
+    calculate the WC base pairing distances between all bases on a sequence
     :param u:
     :return:
     """
-    n_bases = u.segments[0].residues.n_residues
-    atomIndices1 = np.zeros((n_bases, n_bases))
-    atomIndices2 = np.zeros_like(atomIndices1)
-    # identify relevant atoms for WC distance calculation
-    for i in range(1, n_bases + 1):
-        for j in range(1, n_bases + 1):
-            if u.select_atoms(" resid {0!s} ".format(i)).resnames[0] in ["DC", "DT", "U", "C", "T", "CYT", "THY", "URA"]:
-                a1, a2 = "N3", "N1"
-            if u.select_atoms(" resid {0!s} ".format(i)).resnames[0] in ["DG", "DA", "A", "G", "ADE", "GUA"]:
-                a1, a2 = "N1", "N3"
-            atoms = u.select_atoms("(resid {0!s} and name {1!s}) or (resid {2!s} and name {3!s}) ".format(i, a1, j, a2))
-            atomIndices1[i - 1, j - 1] = atoms[0].id  # bond-mate 1
-            if i == j:
-                atomIndices2[i - 1, j - 1] = atoms[0].id  # if it's the same base, we want the resulting distance to always be zero
-            else:
-                atomIndices2[i - 1, j - 1] = atoms[1].id  # bond-mate 2
-
-    # make a flat list of every combination
-    bonds = [mda.AtomGroup(atomIndices1.flatten(), u), mda.AtomGroup(atomIndices2.flatten(), u)]
-    na = atomDistances(bonds).run()
-    traj = na.results.reshape(u.trajectory.n_frames, n_bases, n_bases)
+    bondMates, N1, N3, pyrimidines = getWCAtomIndices(u)
+    n_bases = len(bondMates)
+    atoms = u.atoms[np.concatenate((bondMates, N1, N3))]
+    traj = np.zeros((u.trajectory.n_frames, n_bases, n_bases))
+    for tt, ts in enumerate(u.trajectory):
+        positions = atoms.positions
+        dists = distances.distance_array(positions[:n_bases], positions[n_bases:], box=u.dimensions)  # bond-mates against all N1 and N3
+        traj[tt] = np.where(pyrimidines[:, None], dists[:, :n_bases], dists[:, n_bases:])  # bond-mate 2 is N1 for pyrimidines, N3 for purines
+    traj[:, np.arange(n_bases), np.arange(n_bases)] = 0  # a base is not paired with itself
 
     return traj
 
-def getNucDATraj(u):
+# backbone dihedrals alpha to zeta: (residue offset, atom name) of their 4 atoms
+nucDADihedrals = [((-1, "O3'"), (0, "P"), (0, "O5'"), (0, "C5'")),
+                  ((0, "P"), (0, "O5'"), (0, "C5'"), (0, "C4'")),
+                  ((0, "O5'"), (0, "C5'"), (0, "C4'"), (0, "C3'")),
+                  ((0, "C5'"), (0, "C4'"), (0, "C3'"), (0, "O3'")),
+                  ((0, "C4'"), (0, "C3'"), (0, "O3'"), (1, "P")),
+                  ((0, "C3'"), (0, "O3'"), (1, "P"), (1, "O5'"))]
+nucDAPlans = {}  # cache of dihedral plans, by topology
+
+def getNucDAPlan(u):
     """
-    use analysis.dihedral to quickly compute dihedral angles for a given DNA sequence
+    atom indices of the backbone dihedrals (alpha to zeta) of a DNA sequence, looked up by residue and atom name
+    computed once per topology, so that universes of the same aptamer (eg. free and bound) share the plan
     :param u:
-    :return: dihderals
+    :return: bases x dihedral types x 4 atoms array of atom indices
     """
     n_bases = u.segments[0].residues.n_residues
-    seg = "A"
-    a, b, g, d, e, z, c = [[], [], [], [], [], [], []]
-    for i in range(2, n_bases - 1):  # cutoff end bases to ensure we always have 4 atoms for every dihedral unit
-        a.append(u.select_atoms(" atom {0!s} {1!s} O3\' ".format(seg, i - 1),
-                                " atom {0!s} {1!s} P  ".format(seg, i),
-                                " atom {0!s} {1!s} O5\' ".format(seg, i),
-                                " atom {0!s} {1!s} C5\' ".format(seg, i)))
-
-        b.append(u.select_atoms(" atom {0!s} {1!s} P    ".format(seg, i),
-                                " atom {0!s} {1!s} O5\' ".format(seg, i),
-                                " atom {0!s} {1!s} C5\' ".format(seg, i),
-                                " atom {0!s} {1!s} C4\' ".format(seg, i)))
-
-        g.append(u.select_atoms(" atom {0!s} {1!s} O5\' ".format(seg, i),
-                                " atom {0!s} {1!s} C5\' ".format(seg, i),
-                                " atom {0!s} {1!s} C4\' ".format(seg, i),
-                                " atom {0!s} {1!s} C3\' ".format(seg, i)))
-
-        d.append(u.select_atoms(" atom {0!s} {1!s} C5\' ".format(seg, i),
-                                " atom {0!s} {1!s} C4\' ".format(seg, i),
-                                " atom {0!s} {1!s} C3\' ".format(seg, i),
-                                " atom {0!s} {1!s} O3\' ".format(seg, i)))
-
-        e.append(u.select_atoms(" atom {0!s} {1!s} C4\' ".format(seg, i),
-                                " atom {0!s} {1!s} C3\' ".format(seg, i),
-                                " atom {0!s} {1!s} O3\' ".format(seg, i),
-                                " atom {0!s} {1!s} P    ".format(seg, i + 1)))
-
-        z.append(u.select_atoms(" atom {0!s} {1!s} C3\' ".format(seg, i),
-                                " atom {0!s} {1!s} O3\' ".format(seg, i),
-                                " atom {0!s} {1!s} P    ".format(seg, i + 1),
-                                " atom {0!s} {1!s} O5\' ".format(seg, i + 1)))
-
-        # c.append(u.select_atoms(" atom {0!s} {1!s} O4\' ".format(seg, i), # doesn't always get 4 atoms
-        #                          " atom {0!s} {1!s} C1\' ".format(seg, i),
-        #                          " atom {0!s} {1!s} N9 ".format(seg, i),
-        #                          " atom {0!s} {1!s} C4  ".format(seg, i)))
-
-    atomList = [a, b, g, d, e, z]
-
-    dihedrals = np.zeros((u.trajectory.n_frames, len(a), 6))  # initialize combined trajectory
-    for i in range(len(atomList)):  # for each type of dihedral, compute the trajectory for all bases
-        analysis = Dihedral(atomList[i])
-        analysis.run()
-        dihedrals[:, :, i] = analysis.angles
-
-    return dihedrals % 360  # convert from -180:180 to 0:360 basis
+    atoms = u.select_atoms("segid A")
+    key = (n_bases, tuple(atoms.indices), tuple(atoms.resids), tuple(atoms.names))
+    if key not in nucDAPlans:
+        atomTable = {(resid, name): index for index, resid, name in zip(atoms.indices, atoms.resids, atoms.names)}
+        try:
+            nucDAPlans[key] = np.asarray([[[atomTable[(i + offset, name)] for offset, name in dihedral] for dihedral in nucDADihedrals]
+                                          for i in range(2, n_bases - 1)], dtype=int).reshape(-1, len(nucDADihedrals), 4)  # cutoff end bases to ensure we always have 4 atoms for every dihedral unit
+        except KeyError:
+            raise ValueError("All AtomGroups must contain 4 atoms")
+
+    return nucDAPlans[key]
+
+def getNucDATraj(u, start=0):
+    """
+    compute the backbone dihedral angles for a given DNA sequence, with a single vectorized calculation per frame
+    :param u:
+    :param start: first frame to analyze
+    :return: dihderals
+    """
+    return trajectoryFeatureReader(u, ['dihedrals']).run(start=start)['dihedrals']  # in a 0:360 basis
+
+class trajectoryFeatureReader:
+    """
+    read a trajectory once, computing several per-frame features together
+    'wc distances' as getWCDistTraj, 'base distances' as getBaseBaseDistTraj, 'dihedrals' as getNucDATraj and 'peptide distances' as getPepBaseDistTraj
+    the positions of all atoms needed by any feature are gathered a chunk of frames at a time, into a preallocated buffer
+    """
+
+    def __init__(self, u, features, peptide=None, sequence=None):
+        """
+        :param u: MDA universe
+        :param features: list of feature names
+        :param peptide: for 'peptide distances'
+        :param sequence: for 'peptide distances'
+        """
+        self.u = u
+        self.features = features
+        self.shapes = {}  # of the features of a single frame
+        atomIndices = {}  # atoms needed by each feature
+
+        if 'wc distances' in features:
+            bondMates, N1, N3, self.pyrimidines = getWCAtomIndices(u)
+            atomIndices['wc distances'] = np.concatenate((bondMates, N1, N3))
+            self.shapes['wc distances'] = (len(bondMates), len(bondMates))
+        if 'base distances' in features:
+            self.basePlan = getResidueAtomPlan(u.segments[0].residues)
+            atomIndices['base distances'] = self.basePlan[0].indices
+            self.shapes['base distances'] = (len(self.basePlan[1]), len(self.basePlan[1]))
+        if 'dihedrals' in features:
+            quadruplets = getNucDAPlan(u)  # bases x dihedral types x 4 atoms
+            atomIndices['dihedrals'] = quadruplets.reshape(-1, 4)
+            self.shapes['dihedrals'] = quadruplets.shape[:2]
+        if 'peptide distances' in features:
+            self.analytePlan = getResidueAtomPlan(u.segments[1].residues[:len(peptide)])
+            self.sequencePlan = getResidueAtomPlan(u.segments[0].residues[:len(sequence)])
+            atomIndices['peptide distances'] = np.concatenate((self.analytePlan[0].indices, self.sequencePlan[0].indices))
+            self.shapes['peptide distances'] = (len(peptide), len(sequence))
+
+        self.atoms = u.atoms[np.unique(np.concatenate([indices.flatten() for indices in atomIndices.values()]))]
+        self.localIndices = {feature: np.searchsorted(self.atoms.indices, indices) for feature, indices in atomIndices.items()}  # into the gathered positions
+
+    def computeChunk(self, positions, dimensions):
+        """
+        compute the features of a chunk of frames
+        :param positions: frames x atoms x 3 positions of self.atoms
+        :param dimensions: box dimensions of each frame
+        :return: dict of features, frames first
+        """
+        nFrames = len(positions)
+        chunk = {feature: np.zeros((nFrames,) + shape) for feature, shape in self.shapes.items()}
+
+        if 'wc distances' in self.features:
+            n_bases = len(self.pyrimidines)
+            for tt in range(nFrames):
+                wcPositions = positions[tt, self.localIndices['wc distances']]
+                dists = distances.distance_array(wcPositions[:n_bases], wcPositions[n_bases:], box=dimensions[tt])  # bond-mates against all N1 and N3
+                chunk['wc distances'][tt] = np.where(self.pyrimidines[:, None], dists[:, :n_bases], dists[:, n_bases:])
+            chunk['wc distances'][:, np.arange(n_bases), np.arange(n_bases)] = 0  # a base is not paired with itself
+
+        if 'base distances' in self.features:
+            centroids = getResidueCentroids(positions[:, self.localIndices['base distances']], self.basePlan)
+            for tt in range(nFrames):
+                chunk['base distances'][tt] = distances.distance_array(centroids[tt], centroids[tt], box=dimensions[tt])
+
+        if 'dihedrals' in self.features:
+            quadruplets = self.localIndices['dihedrals']
+            for tt in range(nFrames):
+                angles = calc_dihedrals(*[positions[tt, quadruplets[:, i]] for i in range(4)], box=dimensions[tt])
+                chunk['dihedrals'][tt] = np.rad2deg(angles).reshape(self.shapes['dihedrals']) % 360  # convert from -180:180 to 0:360 basis
+
+        if 'peptide distances' in self.features:
+            nAnalyteAtoms = self.analytePlan[0].n_atoms
+            analyteCentroids = getResidueCentroids(positions[:, self.localIndices['peptide distances'][:nAnalyteAtoms]], self.analytePlan)
+            sequenceCentroids = getResidueCentroids(positions[:, self.localIndices['peptide distances'][nAnalyteAtoms:]], self.sequencePlan)
+            for tt in range(nFrames):
+                chunk['peptide distances'][tt] = distances.distance_array(analyteCentroids[tt], sequenceCentroids[tt], box=dimensions[tt])
+
+        return chunk
+
+    def iterate(self, start=0, stop=None, step=1, chunkSize=100):
+        """
+        yield the features of the frames from start to stop, every step frames, one chunk of frames at a time
+        for trajectories whose features do not fit in memory
+        :return:
+        """
+        buffer = np.zeros((chunkSize, self.atoms.n_atoms, 3), dtype=np.float32)
+        dimensions = []
+        for ts in self.u.trajectory[start:stop:step]:
+            buffer[len(dimensions)] = self.atoms.positions
+            dimensions.append(None if ts.dimensions is None else np.copy(ts.dimensions))
+            if len(dimensions) == chunkSize:
+                yield self.computeChunk(buffer, dimensions)
+                dimensions = []
+
+        if len(dimensions) > 0:
+            yield self.computeChunk(buffer[:len(dimensions)], dimensions)
+
+    def run(self, start=0, stop=None, step=1, chunkSize=100):
+        """
+        compute the features of the frames from start to stop, every step frames
+        :return: dict of features, in arrays preallocated for all frames
+        """
+        nFrames = len(range(*slice(start, stop, step).indices(self.u.trajectory.n_frames)))
+        results = {feature: np.zeros((nFrames,) + shape) for feature, shape in self.shapes.items()}
+        tt = 0
+        for chunk in self.iterate(start, stop, step, chunkSize):
+            chunkFrames = len(next(iter(chunk.values())))
+            for feature, values in chunk.items():
+                results[feature][tt:tt + chunkFrames] = values
+            tt += chunkFrames
+
+        return results
+
+class featureStore:
+    """
+    per-run store of the per-frame features (reaction coordinates) of trajectories, so that they are extracted from the coordinates only once
+    the features of each trajectory file are kept as blocks of consecutive frames, one uncompressed .npy file per feature and block
+    frames appended to a trajectory (eg, by a new MD segment) are extracted in a single pass and written as a new block, so each append only writes the new frames
+    a read from a frame within one block (eg, the latest segment) is memory-mapped, and only the frames used are read from disk; a read spanning blocks is a concatenated copy
+    trade-off: compressed blocks (np.savez_compressed) would take less disk space, but would be decompressed into memory in full on every read
+    index.json lists the blocks of each trajectory, as [first frame, last frame + 1, file], with a fingerprint of its first frame to notice a trajectory which was overwritten
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.indexFile = os.path.join(self.directory, 'index.json')
+
+    def readIndex(self):
+        if os.path.exists(self.indexFile):
+            with open(self.indexFile, 'r') as f:
+                return json.load(f)
+        else:
+            return {}
+
+    def writeIndex(self, index):
+        tmpFile = self.indexFile + '.tmp'
+        with open(tmpFile, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmpFile, self.indexFile)  # atomic, in case the job is killed while writing
+
+    def getFeatures(self, topology, trajectory, features, peptide=None, sequence=None, start=0):
+        """
+        features of the frames of a trajectory from 'start' on, as trajectoryFeatureReader computes them
+        frames which are not in the store yet are extracted, and added to it
+        :param topology:
+        :param trajectory: dcd file
+        :param features: list of feature names
+        :param peptide: for 'peptide distances'
+        :param sequence: for 'peptide distances'
+        :param start: first frame
+        :return: dict of feature arrays
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        u = mda.Universe(topology, trajectory)
+        nFrames = u.trajectory.n_frames
+        fingerprint = hashlib.sha256(u.trajectory[0].positions.tobytes()).hexdigest() if nFrames > 0 else None
+        key = os.path.abspath(trajectory)
+
+        with fileLock(self.indexFile + '.lock'):
+            entry = self.readIndex().get(key)
+        if (entry is None) or (entry['fingerprint'] != fingerprint) or (entry['frames'] > nFrames):  # a new or overwritten trajectory
+            entry = {'fingerprint': fingerprint, 'frames': nFrames, 'features': {}}
+        entry['frames'] = nFrames
+        for feature in features:
+            entry['features'].setdefault(feature, [])
+
+        storedFrames = {feature: (entry['features'][feature][-1][1] if len(entry['features'][feature]) > 0 else 0) for feature in features}
+        firstNew = min(storedFrames.values())
+        if firstNew < nFrames:  # extract every missing feature in a single pass over the new frames, without the lock: only the task which samples a trajectory extends its entry
+            newFeatures = trajectoryFeatureReader(u, [feature for feature in features if storedFrames[feature] < nFrames], peptide, sequence).run(start=firstNew)
+            for feature, values in newFeatures.items():
+                blockFile = '{}_{}_{}-{}.npy'.format(hashlib.sha256(key.encode()).hexdigest()[:16], feature.replace(' ', '_'), storedFrames[feature], nFrames)
+                np.save(os.path.join(self.directory, blockFile), values[storedFrames[feature] - firstNew:])
+                entry['features'][feature].append([storedFrames[feature], nFrames, blockFile])
+
+            with fileLock(self.indexFile + '.lock'):  # other trajectories' entries may have changed in the meantime
+                index = self.readIndex()
+                index[key] = entry
+                self.writeIndex(index)
+
+        return {feature: self.readFeature(entry['features'][feature], start) for feature in features}
+
+    def readFeature(self, blocks, start=0):
+        """
+        read a feature from its blocks, from frame 'start' on
+        :param blocks: list of [first frame, last frame + 1, file]
+        :param start:
+        :return: memory-mapped array if the frames are all in one block, a concatenated copy otherwise
+        """
+        arrays = [np.load(os.path.join(self.directory, blockFile), mmap_mode='r')[max(start - first, 0):] for first, stop, blockFile in blocks if stop > start]
+        if len(arrays) == 1:
+            return arrays[0]
+        else:
+            return np.concatenate(arrays)
+
+    def getAllFeatures(self):
+        """
+        everything in the store, eg for post-processing
+        :return: dict of the features of each trajectory file
+        """
+        return {trajectory: {feature: self.readFeature(blocks) for feature, blocks in entry['features'].items()} for trajectory, entry in self.readIndex().items()}
+
+    def update(self, entries):
+        """
+        add index entries, eg, those of the tasks of parallel branches, whose blocks are already in this directory
+        an entry which another task has since extended (more frames of the same trajectory) is kept
+        :param entries: dict of index entries of trajectory files
+        :return:
+        """
+        if len(entries) == 0:
+            return
+        with fileLock(self.indexFile + '.lock'):
+            index = self.readIndex()
+            for trajectory, entry in entries.items():
+                current = index.get(trajectory)
+                if (current is None) or (current['fingerprint'] != entry['fingerprint']) or (current['frames'] <= entry['frames']):
+                    index[trajectory] = entry
+            self.writeIndex(index)
+
+    def rename(self, trajectory, newTrajectory, keep=False):
+        """
+        follow a trajectory file which was renamed (or copied, with keep=True), so that its features are found under its new name
+        :param trajectory:
+        :param newTrajectory:
+        :param keep: keep the entry of the old name too
+        :return:
+        """
+        if not os.path.exists(self.indexFile):
+            return
+        with fileLock(self.indexFile + '.lock'):
+            index = self.readIndex()
+            if os.path.abspath(trajectory) in index:
+                entry = index[os.path.abspath(trajectory)] if keep else index.pop(os.path.abspath(trajectory))
+                index[os.path.abspath(newTrajectory)] = entry
+                self.writeIndex(index)
+
+
+def getTrajectoryFeatures(topology, trajectory, features, peptide=None, sequence=None, start=0, store=None):
+    """
+    per-frame features of a trajectory, from a feature store if one is given, otherwise extracted from the coordinates
+    :return: dict of feature arrays
+    """
+    if store is not None:
+        return store.getFeatures(topology, trajectory, features, peptide, sequence, start)
+    else:
+        return trajectoryFeatureReader(mda.Universe(topology, trajectory), features, peptide, sequence).run(start=start)
 
 def getMoleculeSize(structure):
     """
@@ -242,6 +519,41 @@ def getMoleculeSize(structure):
     return dimensions
 
 
+def getSASA(structure, probeRadius=1.4, nSpherePoints=100):
+    """
+    use MDAnalysis and a vectorized Shrake-Rupley algorithm to compute the solvent accessible surface area of a molecule
+    test points on the probe-expanded sphere of every atom are buried if they fall inside the sphere of a neighbouring atom
+    :param structure: pdb file
+    :param probeRadius: angstroms - water
+    :param nSpherePoints: test points per atom
+    :return: surface area in square angstroms
+    """
+    vdwRadii = {'H': 1.2, 'C': 1.7, 'N': 1.55, 'O': 1.52, 'P': 1.8, 'S': 1.8}  # Bondi, angstroms
+    u = mda.Universe(structure)
+    positions = u.atoms.positions.astype(float)
+    radii = np.asarray([vdwRadii.get(atomType[0].upper(), 1.8) for atomType in u.atoms.types]) + probeRadius
+
+    # evenly spread test points on the unit sphere (golden spiral)
+    z = 1 - (2 * np.arange(nSpherePoints) + 1) / nSpherePoints
+    theta = np.pi * (3 - np.sqrt(5)) * np.arange(nSpherePoints)
+    spherePoints = np.stack((np.sqrt(1 - z ** 2) * np.cos(theta), np.sqrt(1 - z ** 2) * np.sin(theta), z), axis=1)
+
+    # every (atom, neighbour) pair whose expanded spheres may overlap
+    pairs = spatial.cKDTree(positions).query_pairs(2 * np.amax(radii), output_type='ndarray')
+    pairs = np.concatenate((pairs, pairs[:, ::-1]))
+
+    buried = np.zeros((len(positions), nSpherePoints), dtype=bool)
+    for chunk in np.array_split(pairs, max(1, len(pairs) // 10000)):  # bounded memory
+        atoms, neighbours = chunk[:, 0], chunk[:, 1]
+        points = positions[atoms, None, :] + radii[atoms, None, None] * spherePoints[None, :, :]
+        inside = np.sum((points - positions[neighbours, None, :]) ** 2, axis=-1) < radii[neighbours, None] ** 2
+        np.logical_or.at(buried, atoms, inside)
+
+    exposedFraction = 1 - np.mean(buried, axis=1)
+
+    return np.sum(4 * np.pi * radii ** 2 * exposedFraction)
+
+
 # Secondary structure analysis utils
 def pairListToConfig(pairList, seqLen):
     '''
@@ -510,27 +822,20 @@ def do_kdtree(trajectory, coordinates):
 def enumerate2DConfigurations(pairTraj):
     '''
     explicitly enumerate and count every unique 2D strcutre
-    in the pair trajectory
+    in the pair trajectory, in order of first appearance
     :param pairTraj:
     :return: config list, counts
     '''
     # might be useful for clustering
-    configs = []
-    counter = []
-    for tt in range(len(pairTraj)):  # find the equilibrium secondary structure
-        if tt == 0:
-            configs.append(pairTraj[tt])
-            counter.append(0)
-        else:
-            found = 0
-            for i in range(len(configs)):
-                if all(pairTraj[tt] == configs[i]):
-                    counter[i] += 1  # add one to the population of the state
-                    found = 1
+    pairTraj = np.asarray(pairTraj)
+    if len(pairTraj) == 0:
+        return [], []
 
-            if found == 0:  # if we don't find it, enumerate a new possible state
-                configs.append(pairTraj[tt])
-                counter.append(1)
+    _, firstFrames, counts = np.unique(pairTraj, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(firstFrames)
+    configs = [pairTraj[tt] for tt in firstFrames[order]]
+    counter = counts[order].tolist()
+    counter[0] -= 1  # the very first frame has never been counted
 
     return configs, counter
 
@@ -561,6 +866,24 @@ def doMultiDProbabilityMap(trajectory, range=None, nBins=None):
 
     return probs, smoothProbs, bins, nbins
 
+def getSampleDensity(trajectory, radius=0.1, chunkSize=1000):
+    """
+    density of a trajectory at each of its own frames: the number of frames within radius of it, with every dimension scaled to its range
+    unlike a multidimensional histogram, memory scales with the number of frames, not bins^dimensions
+    :param trajectory: frames x dimensions
+    :param radius: fraction of the range of each dimension
+    :param chunkSize: frames queried at once
+    :return: neighbour count of each frame
+    """
+    ranges = np.ptp(trajectory, axis=0)
+    scaledTrajectory = trajectory / np.where(ranges > 0, ranges, 1)
+    tree = spatial.cKDTree(scaledTrajectory)
+    density = np.zeros(len(trajectory), dtype=int)
+    for start in range(0, len(trajectory), chunkSize):
+        density[start:start + chunkSize] = tree.query_ball_point(scaledTrajectory[start:start + chunkSize], radius, return_length=True)
+
+    return density
+
 def doTrajectoryDimensionalityReduction(trajectory):
     """
     automatically generate dimension-reduced trajectory using PCA
@@ -583,11 +906,12 @@ def doTrajectoryDimensionalityReduction(trajectory):
 
     return n_components, reducedTrajectory, pcaModel
 
-def isolateRepresentativeStructure(trajectory):
+def isolateRepresentativeStructure(trajectory, mode='density'):
     """
     use PCA to identify collective variables
     identify the most probable structure and save it
     :param trajectory:
+    :param mode: 'density': the frame with the most neighbours in the reduced space; 'histogram': the frame closest to the maximum of the smoothed multidimensional histogram (memory grows as bins^dimensions)
     :return:
     """
     n_components, reducedTrajectory, pcaModel = doTrajectoryDimensionalityReduction(trajectory)
@@ -596,6 +920,10 @@ def isolateRepresentativeStructure(trajectory):
     for i in range(reducedTrajectory.shape[-1]): # normalize the contribution of each PC by its eigenvalue (importance)
         reducedTrajectory[:,i] = reducedTrajectory[:,i] * eigenvalues[i]
 
+    if mode == 'density':
+        representativeIndex = int(np.argmax(getSampleDensity(reducedTrajectory)))
+        return representativeIndex, reducedTrajectory, eigenvalues
+
     probs, smoothProbs, bins, nbins = doMultiDProbabilityMap(reducedTrajectory)
 
     bestTransformedStructureIndex = np.unravel_index(smoothProbs.argmax(), smoothProbs.shape)
@@ -616,15 +944,19 @@ def isolateRepresentativeStructure(trajectory):
 
     return representativeIndex, reducedTrajectory, eigenvalues
 
-def bindingAnalysis(bindu, freeu, peptide, sequence):
+def bindingAnalysis(bindu, freeu, peptide, sequence, bindFeatures=None, freeAngles=None):
     """
     analyze the binding of analyte to aptamer by computing relative distances
     :param u:
+    :param bindFeatures: 'peptide distances' and 'dihedrals' of bindu, if already computed
+    :param freeAngles: dihedrals of freeu, if already computed
     :return:
     """
     assert bindu.segments.n_segments == 2
-    # identify base-analyte distances
-    pepNucDists = getPepBaseDistTraj(bindu, peptide, sequence)
+    # identify base-analyte distances, and the aptamer dihedrals for the conformation change, in a single pass
+    if bindFeatures is None:
+        bindFeatures = trajectoryFeatureReader(bindu, ['peptide distances', 'dihedrals'], peptide, sequence).run()
+    pepNucDists = bindFeatures['peptide distances']
     contacts, nContacts = getPepContactTraj(pepNucDists)
     if np.nonzero(nContacts[:,0])[0] != []:
         firstContact = np.nonzero(nContacts[:, 0])[0][0]  # first time when the peptide and aptamer were in close-range contact
@@ -635,7 +967,7 @@ def bindingAnalysis(bindu, freeu, peptide, sequence):
         closeContactRatio = 0
         contactScore = 0
 
-    conformationChange = getConformationChange(bindu, freeu)
+    conformationChange = getConformationChange(bindu, freeu, bindAngles=bindFeatures['dihedrals'], freeAngles=freeAngles)
 
     # build directory of outputs
     outDict = {
@@ -649,15 +981,19 @@ def bindingAnalysis(bindu, freeu, peptide, sequence):
 
     return outDict
 
-def getConformationChange(bindu, freeu):
+def getConformationChange(bindu, freeu, bindAngles=None, freeAngles=None):
     """
     compare the pre-complexation (free aptamer) conformation with post-complexation
     NOTE intimately depends on naming conventions for trajectory files!
+    :param bindAngles: dihedrals of bindu, if already computed
+    :param freeAngles: dihedrals of freeu, if already computed
     """
     # function to analyze analyte impact on aptamer conformation
 
-    freeAngles = getNucDATraj(freeu)
-    bindAngles = getNucDATraj(bindu)
+    if freeAngles is None:
+        freeAngles = getNucDATraj(freeu)
+    if bindAngles is None:
+        bindAngles = getNucDATraj(bindu)
 
     n_components, freeReducedTrajectory, pcaModel = doTrajectoryDimensionalityReduction(freeAngles) # get free aptamer PCA
     bindReducedTrajectory = pcaModel.transform(bindAngles.reshape(len(bindAngles), int(bindAngles.shape[-2] * bindAngles.shape[-1]))) # transform complex trajectory to free aptamer pca basis
@@ -671,38 +1007,39 @@ def getConformationChange(bindu, freeu):
 
     return reducedDifference
 
-def checkMidTrajectoryBinding(structure, trajectory, peptide, sequence, params, cutoffTime=1):
+def checkMidTrajectoryBinding(structure, trajectory, peptide, sequence, params, cutoffTime=1, start=0, lastContact=None, store=None):
     """
     check if the analyte has come unbound from the aptamer
     and stayed unbound for a certain amount of time
-    :return: True or False
+    only the frames from 'start' on (eg, of the latest MD segment) are analyzed; the last contact before them is carried over
+    :param start: first frame to analyze
+    :param lastContact: frame of the last contact before 'start', from the previous check, if any
+    :param store: featureStore, if any
+    :return: True or False, and the frame of the last contact, for the next check
     """
-    u = mda.Universe(structure, trajectory)  # load up trajectory
-    pepNucDists = getPepBaseDistTraj(u, peptide, sequence)
+    pepNucDists = getTrajectoryFeatures(structure, trajectory, ['peptide distances'], peptide, sequence, start=start, store=store)['peptide distances']
     contacts, nContacts = getPepContactTraj(pepNucDists)
-    try:
-        lastContact = np.nonzero(nContacts[:, 0])[0][-1]  # last time when the peptide and aptamer were in close-range contact
+    contactFrames = np.nonzero(nContacts[:, 0])[0]
+    if len(contactFrames) > 0:
+        lastContact = start + contactFrames[-1]  # last time when the peptide and aptamer were in close-range contact
+    if lastContact is None:
+        return False, None  # if we never attached, give up
 
-        dt = params['print step']
-        detachedTime = (len(nContacts) - lastContact) * dt / 1e3  # in ns, since dt is in ps
-        if detachedTime > cutoffTime:  # if we have been unbound longer than the cutoff
-            return True
-        else:  # otherwise keep going
-            return False
-    except IndexError:
-        return False # if we never attached, give up
+    dt = params['print step']
+    detachedTime = (start + len(nContacts) - lastContact) * dt / 1e3  # in ns, since dt is in ps
+    return detachedTime > cutoffTime, lastContact  # if we have been unbound longer than the cutoff; otherwise keep going
 
-def checkTrajPCASlope(topology, trajectory, printStep):
+def checkTrajPCASlope(topology, trajectory, printStep, store=None):
     """
     analyze the trajectory to see if it's converged
+    :param store: featureStore, if any
     """
     converged = 0
     cutoff = 1e-2
 
-    u = mda.Universe(topology, trajectory)
-
-    baseDists = getBaseBaseDistTraj(u)  # FAST, base-base center-of-geometry distances
-    baseAngles = getNucDATraj(u)  # FAST, new, omits 'chi' angle between ribose and base
+    features = getTrajectoryFeatures(topology, trajectory, ['base distances', 'dihedrals'], store=store)  # single pass over the trajectory
+    baseDists = features['base distances']  # base-base center-of-geometry distances
+    baseAngles = features['dihedrals']  # omits 'chi' angle between ribose and base
 
     mixedTrajectory = np.concatenate((baseDists.reshape(len(baseDists), int(baseDists.shape[-2] * baseDists.shape[-1])), baseAngles.reshape(len(baseAngles), int(baseAngles.shape[-2] * baseAngles.shape[-1]))),
                                      axis=1)  # mix up all our info
@@ -719,3 +1056,118 @@ def checkTrajPCASlope(topology, trajectory, printStep):
     printRecord('PCA slope average is %.4f' % combinedSlope)
 
     return combinedSlope
+
+class trajectoryConvergenceMonitor:
+    """
+    streaming version of checkTrajPCASlope for segmented sampling
+    each new segment's frames are analyzed once and folded into running moments of the features (mean and covariance) and of their drift in time,
+    from which the PCA and the PC slopes of the whole trajectory so far follow exactly, without revisiting earlier frames
+    with several independent replicas, the PCA is done on the frames of all replicas, and the slopes are judged for each replica
+    """
+
+    def __init__(self, topology, printStep, replicas=1, store=None):
+        """
+        :param topology: structure shared by all trajectory segments
+        :param printStep: time between frames
+        :param replicas: number of independent trajectories
+        :param store: featureStore, to which the features of each new segment are added
+        """
+        self.topology = topology
+        self.printStep = printStep
+        self.store = store
+        self.totalFrames = 0
+        self.featureMean = None  # over the frames of all replicas
+        self.featureM2 = None  # sum over frames of (x - mean)(x - mean)^T
+        self.nFrames = np.zeros(replicas, dtype=int)  # for each replica
+        self.replicaMean = [None] * replicas
+        self.timeMean = np.zeros(replicas)
+        self.timeM2 = np.zeros(replicas)  # sum over frames of (t - mean)^2
+        self.timeFeatureM2 = [None] * replicas  # sum over frames of (t - mean)(x - mean)
+
+    def update(self, *trajectories):
+        """
+        add the frames of a new trajectory segment
+        :param trajectories: for each replica, the dcd file to which its new segment was appended
+        :return: the combined PCA slope of all segments so far
+        """
+        for replica in range(len(trajectories)):
+            features = getTrajectoryFeatures(self.topology, trajectories[replica], ['base distances', 'dihedrals'], start=self.nFrames[replica], store=self.store)  # single pass over the new frames
+            baseDists = features['base distances']  # base-base center-of-geometry distances
+            baseAngles = features['dihedrals']  # omits 'chi' angle between ribose and base
+            mixedTrajectory = np.concatenate((baseDists.reshape(len(baseDists), int(baseDists.shape[-2] * baseDists.shape[-1])), baseAngles.reshape(len(baseAngles), int(baseAngles.shape[-2] * baseAngles.shape[-1]))),
+                                             axis=1)  # same features as checkTrajPCASlope
+            self.addFrames(mixedTrajectory, replica)
+        combinedSlope = self.getCombinedSlope()
+        printRecord('PCA slope average is %.4f' % combinedSlope)
+
+        return combinedSlope
+
+    def addFrames(self, features, replica=0):
+        """
+        merge the moments of a block of new frames into the running moments (pairwise update of Chan et al.)
+        :param features: (frames, features) array
+        :param replica:
+        :return:
+        """
+        n = len(features)
+        times = np.arange(self.nFrames[replica], self.nFrames[replica] + n)
+        mean, timeMean = np.mean(features, axis=0), np.mean(times)
+        centered, centeredTimes = features - mean, times - timeMean
+        M2, timeM2, timeFeatureM2 = centered.T @ centered, np.sum(centeredTimes ** 2), centeredTimes @ centered
+
+        if self.totalFrames == 0:
+            self.featureMean, self.featureM2 = mean.copy(), M2
+        else:
+            total = self.totalFrames + n
+            delta = mean - self.featureMean
+            self.featureM2 += M2 + self.totalFrames * n / total * np.outer(delta, delta)
+            self.featureMean += delta * n / total
+        self.totalFrames += n
+
+        if self.nFrames[replica] == 0:
+            self.replicaMean[replica], self.timeMean[replica], self.timeM2[replica], self.timeFeatureM2[replica] = mean, timeMean, timeM2, timeFeatureM2
+        else:
+            total = self.nFrames[replica] + n
+            weight = self.nFrames[replica] * n / total
+            delta, timeDelta = mean - self.replicaMean[replica], timeMean - self.timeMean[replica]
+            self.timeM2[replica] += timeM2 + weight * timeDelta ** 2
+            self.timeFeatureM2[replica] += timeFeatureM2 + weight * timeDelta * delta
+            self.replicaMean[replica] += delta * n / total
+            self.timeMean[replica] += timeDelta * n / total
+        self.nFrames[replica] += n
+
+    def getPCA(self):
+        """
+        choose principal components as doTrajectoryDimensionalityReduction does, from the covariance of all frames so far
+        :return: the principal components (columns) and their explained variance ratios
+        """
+        eigenvalues, components = np.linalg.eigh(self.featureM2)
+        eigenvalues, components = np.clip(eigenvalues[::-1], 0, None), components[:, ::-1]
+        eigenvalues = eigenvalues / np.sum(eigenvalues)  # explained variance ratio
+
+        nComponents = min(10, len(eigenvalues))  # add components until 85% of the variance is explained
+        while (np.sum(eigenvalues[:nComponents]) <= 0.85) and (nComponents < len(eigenvalues)):
+            nComponents += 1
+        n_components = min(5, np.sum(eigenvalues[:nComponents] > np.average(eigenvalues[:nComponents])))
+
+        return components[:, :n_components], eigenvalues[:n_components]
+
+    def getCombinedSlope(self):
+        """
+        eigenvalue-weighted norm of the PC slopes in time, as in checkTrajPCASlope
+        the least-squares slope of each PC is linear in the frames, hence given by the time-feature co-moments
+        with several replicas, the largest of their combined slopes, ie, all replicas have to level off
+        :return:
+        """
+        if np.amin(self.nFrames) < 2:
+            return np.inf  # no trend to fit yet
+
+        components, eigenvalues = self.getPCA()
+        combinedSlopes = []
+        for replica in range(len(self.nFrames)):
+            slopes = np.abs(self.timeFeatureM2[replica] @ components) / (self.timeM2[replica] * self.printStep)
+            slopes = slopes * eigenvalues  # isolateRepresentativeStructure weights the PC trajectories by their eigenvalues
+            normedSlope = slopes * (eigenvalues / np.sum(eigenvalues))  # normalize the components contributions by their eigenvalues
+            combinedSlopes.append(np.linalg.norm(normedSlope))
+
+        return np.amax(combinedSlopes)
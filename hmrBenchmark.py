@@ -0,0 +1,135 @@
+"""
+Benchmark of the hydrogen mass repartitioning (HMR) performance mode, params['hmr mode'], against the 2 fs baseline
+
+python hmrBenchmark.py --structure relaxedSequence_0.pdb --sampling_time 5 --drift_time 20
+
+The structure is sampled for the same time in each mode, with all other settings (and command line arguments) from main.py.
+For each mode, reports:
+- sampling speed in ns/day
+- energy drift: a short constant energy (Verlet) run from the last frame, with the same System and time step, in kJ/mol/ns per degree of freedom
+- distributions of the reaction coordinates of analyzeTrajectory (WC distances, base-base distances, backbone dihedrals),
+  compared between modes with the Kolmogorov-Smirnov statistic of each coordinate (0: same distribution, 1: no overlap)
+Results are saved to hmrBenchmarkResults.npy in the benchmark directory, with each mode's files in its own sub-directory.
+"""
+import sys
+import argparse
+from scipy import stats
+from simtk.openmm import *
+
+
+def get_benchmark_input():
+    """
+    get the command line input for the benchmark
+    :return: the benchmark arguments, and the remaining arguments, which belong to main.py
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--structure', type=str, required=True)  # folded aptamer, eg, relaxedSequence_0.pdb from a '3d smooth' run
+    parser.add_argument('--sampling_time', type=float, default=5)  # ns of sampling in each mode
+    parser.add_argument('--drift_time', type=float, default=20)  # ps of constant energy dynamics for the energy drift
+    parser.add_argument('--benchmark_dir', type=str, default=None)  # default: params['workdir'] + '/hmrBenchmark'
+
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    cmdLineInputs, mainArgs = get_benchmark_input()
+    sys.argv = sys.argv[:1] + mainArgs  # main.py parses the rest of the command line when it is imported
+
+from main import params
+from opendna import *
+
+# MD settings of each mode, on top of those of main.py
+modes = {'baseline': {'hydrogen mass': 1.5, 'integrator': 'Langevin', 'time step': 2.0},
+         'hmr': {'hydrogen mass': 4.0, 'integrator': 'LangevinMiddle', 'time step': 4.0}}
+rcFeatures = ['wc distances', 'base distances', 'dihedrals']
+
+
+def prepareStructure(structure, modeParams):
+    """
+    solvate (explicit solvent) or add missing atoms and hydrogens without water (implicit solvent, as opendna.prepImplicitSolvent does with the 'openmm' builder) to the structure, before sampling
+    :param structure:
+    :param modeParams:
+    :return: the processed structure, and the solute-only structure and trajectory to analyze
+    """
+    structureName = structure.split('.')[0]
+    if modeParams['implicit solvent'] is False:
+        prepPDB(structure, modeParams['box offset'], modeParams['pH'], modeParams['ionicStrength'], MMBCORRECTION=True, waterBox=True)
+        processedStructure = structureName + '_processed.pdb'
+        return processedStructure, 'clean_' + processedStructure, 'clean_' + structureName + '_processed_trajectory.dcd'
+    else:
+        copyfile(structure, structureName + '_amb.pdb')
+        prepPDB(structureName + '_amb.pdb', modeParams['box offset'], modeParams['pH'], modeParams['ionicStrength'], MMBCORRECTION=True, waterBox=False)
+        processedStructure = structureName + '_amb_processed.pdb'
+        return processedStructure, processedStructure, structureName + '_amb_processed_trajectory.dcd'
+
+
+def getEnergyDrift(omm, driftTime):
+    """
+    drift of the total energy in constant energy dynamics from the last frame of a simulation, with its System and time step
+    :param omm: interfaces.omm, after doMD
+    :param driftTime: in ps
+    :return: drift and standard deviation of the total energy, in kJ/mol/ns and kJ/mol, per degree of freedom
+    """
+    integrator = VerletIntegrator(omm.dt)
+    integrator.setConstraintTolerance(omm.constraintTolerance)
+    context = Context(omm.system, integrator, omm.platform, omm.platformProperties)
+    state = omm.simulation.context.getState(getPositions=True, getVelocities=True)
+    context.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+    context.setPositions(state.getPositions())
+    context.setVelocities(state.getVelocities())
+
+    steps = int(driftTime * 1000 / omm.timeStep)
+    interval = max(steps // 100, 1)
+    times, energies = [], []
+    for i in range(steps // interval):
+        integrator.step(interval)
+        state = context.getState(getEnergy=True)
+        times.append(state.getTime().value_in_unit(unit.nanosecond))
+        energies.append((state.getPotentialEnergy() + state.getKineticEnergy()).value_in_unit(unit.kilojoule_per_mole))
+
+    dof = 3 * omm.system.getNumParticles() - omm.system.getNumConstraints() - 3  # the center of mass motion is removed
+    drift = np.polyfit(times, energies, 1)[0]
+
+    return drift / dof, np.std(energies) / dof
+
+
+if __name__ == '__main__':
+    benchmarkDir = os.path.abspath(cmdLineInputs.benchmark_dir if cmdLineInputs.benchmark_dir is not None else params['workdir'] + '/hmrBenchmark')
+    structure = os.path.abspath(cmdLineInputs.structure)
+    results = {}
+    for mode, modeSettings in modes.items():
+        modeParams = params.copy()
+        modeParams.update(modeSettings)
+        modeParams['sampling time'] = cmdLineInputs.sampling_time
+        modeParams['solute trajectory'] = True  # the analysis reads the solute only
+        modeParams['pick up from chk'] = False
+        modeParams['chk file'] = ""
+        if modeParams['implicit solvent'] is True:
+            modeParams['implicit solvent builder'] = 'openmm'  # no prmtop and crd files to prepare
+
+        modeDir = benchmarkDir + '/' + mode
+        os.makedirs(modeDir, exist_ok=True)
+        os.chdir(modeDir)
+        copyfile(structure, os.path.basename(structure))
+        processedStructure, analysisStructure, analysisTrajectory = prepareStructure(os.path.basename(structure), modeParams)
+
+        printRecord('\n{}: hydrogen mass {} amu, {}Integrator, {} fs time step'.format(mode, modeParams['hydrogen mass'], modeParams['integrator'], modeParams['time step']))
+        omm = interfaces.omm(structure=processedStructure, params=modeParams, implicitSolvent=modeParams['implicit solvent'])
+        nsPerDay = omm.doMD()
+        drift, fluctuation = getEnergyDrift(omm, cmdLineInputs.drift_time)
+        features = getTrajectoryFeatures(analysisStructure, analysisTrajectory, rcFeatures)
+        printRecord('{}: {:.1f} ns/day, energy drift {:.3g} kJ/mol/ns, fluctuation {:.3g} kJ/mol per degree of freedom'.format(mode, nsPerDay, drift, fluctuation))
+
+        results[mode] = {'settings': modeSettings, 'ns per day': nsPerDay, 'energy drift': drift, 'energy fluctuation': fluctuation,
+                         'features': {feature: np.asarray(values) for feature, values in features.items()}}
+
+    os.chdir(benchmarkDir)
+    printRecord('\nHMR speedup: {:.2f}x'.format(results['hmr']['ns per day'] / results['baseline']['ns per day']))
+    for feature in rcFeatures:
+        baseline = results['baseline']['features'][feature].reshape(len(results['baseline']['features'][feature]), -1)
+        hmr = results['hmr']['features'][feature].reshape(len(results['hmr']['features'][feature]), -1)
+        ksStatistics = np.asarray([stats.ks_2samp(baseline[:, k], hmr[:, k]).statistic for k in range(baseline.shape[1])])
+        results['ks ' + feature] = ksStatistics
+        printRecord('{}: Kolmogorov-Smirnov statistic mean {:.3f}, max {:.3f} over {} coordinates'.format(feature, np.mean(ksStatistics), np.amax(ksStatistics), len(ksStatistics)))
+
+    np.save('hmrBenchmarkResults', results)
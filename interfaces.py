@@ -26,26 +26,32 @@ from analysisTools import *
 
 
 class nupack:
-    def __init__(self, sequence, temperature, ionicStrength, mgConc=0):
+    def __init__(self, sequence, temperature, ionicStrength, mgConc=0, cache=None):
         self.sequence = sequence
         self.temperature = temperature
         self.ionicStrength = ionicStrength
         self.naConc = ionicStrength
         self.mgConc = mgConc
         self.R = 0.0019872  # ideal gas constant in kcal/mol/K
+        self.cache = cache  # optional utils.resultCache, shared between runs
 
     def run(self):
+        if self.cache is not None:
+            self.ssDict = self.cache.get(self.getCacheInputs())
+            if self.ssDict is not None:
+                printRecord('Loaded NUPACK analysis of {} from cache'.format(self.sequence))
+                return self.ssDict
+
         self.energyCalc()
         self.structureAnalysis()
+        if self.cache is not None:
+            self.cache.put(self.getCacheInputs(), self.ssDict)
+
         return self.ssDict
 
-    def energyCalc(self):
+    def getConditions(self):
         """
-        sequence is DNA FASTA format
-        temperature in C or K
-        ionicStrength in Molar
-        Ouput a lot of analysis results in self.output
-        :return:
+        :return: temperature in Celsius and the energy gap (2 kT) for suboptimal structures
         """
         if self.temperature > 273:  # auto-detect Kelvins
             gap = 2 * self.R * self.temperature
@@ -54,6 +60,26 @@ class nupack:
             gap = 2 * self.R * (self.temperature + 273)  # convert to Kelvin fir kT
             CelsiusTemprature = self.temperature
 
+        return CelsiusTemprature, gap
+
+    def getCacheInputs(self):
+        """
+        everything the structure analysis depends on
+        :return:
+        """
+        CelsiusTemprature, gap = self.getConditions()
+        return ('nupack', self.sequence, 'dna', self.temperature, self.naConc, self.mgConc, gap)
+
+    def energyCalc(self):
+        """
+        sequence is DNA FASTA format
+        temperature in C or K
+        ionicStrength in Molar
+        Ouput a lot of analysis results in self.output
+        :return:
+        """
+        CelsiusTemprature, gap = self.getConditions()
+
         A = Strand(self.sequence, name='A')
         comp = Complex([A], name='AA')
         set1 = ComplexSet(strands=[A], complexes=SetSpec(max_size=1, include=[comp]))
@@ -235,10 +261,54 @@ class mmb:  # MacroMolecule Builder (MMB)
 
 
 # openmm
+implicitSolventFiles = {HCT: 'implicit/hct.xml', OBC1: 'implicit/obc1.xml', OBC2: 'implicit/obc2.xml', GBn: 'implicit/gbn.xml', GBn2: 'implicit/gbn2.xml'}  # force field file of each GB model, to use with amber14
+
+
+class subsetDCDReporter(object):
+    """
+    OpenMM reporter like DCDReporter, but writing only a subset of the atoms, eg, the solute
+    """
+
+    def __init__(self, file, reportInterval, topology, atoms, append=False):
+        """
+        :param file: dcd file to write
+        :param reportInterval: steps between frames
+        :param topology: topology of the subset only
+        :param atoms: indices of the subset atoms in the full system
+        :param append: add the frames to the end of an existing file
+        """
+        self._reportInterval = reportInterval
+        self._topology = topology
+        self._atoms = atoms
+        self._append = append
+        if append:
+            mode = 'r+b'
+        else:
+            mode = 'wb'
+        self._out = open(file, mode)
+        self._dcd = None
+
+    def describeNextReport(self, simulation):
+        steps = self._reportInterval - simulation.currentStep % self._reportInterval
+        return (steps, True, False, False, False, None)  # next report in 'steps', which only needs positions
+
+    def report(self, simulation, state):
+        if self._dcd is None:
+            self._dcd = DCDFile(self._out, self._topology, simulation.integrator.getStepSize(), simulation.currentStep, self._reportInterval, self._append)
+        positions = state.getPositions(asNumpy=True)[self._atoms]
+        self._dcd.writeModel(positions, periodicBoxVectors=state.getPeriodicBoxVectors())
+
+    def __del__(self):
+        self._out.close()
+
+
 class omm:
-    def __init__(self, structure, params, simTime=None, implicitSolvent=False):
+    def __init__(self, structure, params, simTime=None, implicitSolvent=False, appendTrajectory=False, seed=None, threads=None):
         """
         pass on the pre-set and user-defined params to openmm engine
+        appendTrajectory: add the new frames to the end of an existing trajectory file, eg, in segmented sampling
+        seed: random seed for the integrator and initial velocities, eg, for independent replicas. Random if None
+        threads: number of threads on the CPU platform. All cores if None
         """
         self.structureName = structure.split('.')[0]  # e.g., structure: relaxedSequence_0_amb_processed.pdb
         self.peptide = params['peptide']
@@ -247,7 +317,7 @@ class omm:
         if implicitSolvent is False:
             self.pdb = PDBFile(structure)
             self.waterModel = params['water model']
-            self.forcefield = ForceField('amber14-all.xml', 'amber14/' + self.waterModel + '.xml')
+            self.forcefieldFiles = ('amber14-all.xml', 'amber14/' + self.waterModel + '.xml')
 
         # System configuration
         self.nonbondedMethod = params['nonbonded method']  # Currently PME!!! It's used with periodic boundary condition applied
@@ -258,6 +328,10 @@ class omm:
         self.constraintTolerance = params['constraint tolerance']
         self.hydrogenMass = params['hydrogen mass'] * unit.amu
         self.temperature = params['temperature'] * unit.kelvin
+        if params['system cache'] is True:  # reuse Systems built with the same topology, force field and parameters in previous runs
+            self.systemCache = resultCache(params['cache dir'], params['cache size'])
+        else:
+            self.systemCache = None
 
         # Integration options
         self.dt = params['time step'] / 1000 * unit.picosecond
@@ -285,21 +359,26 @@ class omm:
                 self.platformProperties = {'Precision': 'double'}
         else:
             self.platform = Platform.getPlatformByName('CPU')
+            self.platformProperties = {}
+            if threads is not None:
+                self.platformProperties['Threads'] = str(threads)
+        self.seed = seed
 
         # Can resumed run append the old log.txt or .dcd file?
         self.reportSteps = int(params['print step'] * 1000 / params['time step'])  # report steps in ps, time step in fs
-        self.dcdReporter = DCDReporter(self.structureName + '_trajectory.dcd', self.reportSteps)
+        self.soluteTrajectory = (params['solute trajectory'] is True) and (implicitSolvent is False)  # in implicit solvent, everything is solute
+        self.fullTrajectorySteps = int(params['full trajectory print step'] * 1000 / params['time step'])  # with a solute trajectory, sparse trajectory with water and ions if > 0
         # self.pdbReporter = PDBReporter(self.structureName + '_trajectory.pdb', self.reportSteps)  # huge files
         if simTime is None:
-            logFileName = 'log.txt'
+            self.logFileName = 'log.txt'
         else:  # MD smoothing: simTime is specified as 'smoothing time'
-            logFileName = 'log_smoothing.txt'
-        self.dataReporter = StateDataReporter(logFileName, self.reportSteps, totalSteps=self.steps, step=True, speed=True, progress=True, potentialEnergy=True, kineticEnergy=True, totalEnergy=True, temperature=True, volume=True, density=True,separator='\t')        
-                
+            self.logFileName = 'log_smoothing.txt'
+
         if params['pick up from chk'] is False:  # or if not self.chkFile:
-            self.checkpointReporter = CheckpointReporter(self.structureName + '_state.chk', 10000)
+            self.checkpointFile = self.structureName + '_state.chk'
         else:  # ie, we are resuming a sampling, chkFile must exist.
-            self.checkpointReporter = CheckpointReporter(self.chkFile, 10000)                   
+            self.checkpointFile = self.chkFile
+        self.segment = 0  # number of segments run with this simulation, see doMD
             
         # Prepare the simulation        
         if implicitSolvent is False:
@@ -307,8 +386,12 @@ class omm:
             self.positions = self.pdb.positions
             printRecord('Creating a simulation system under explicit solvent')
 
-            self.system = self.forcefield.createSystem(self.topology, nonbondedMethod=self.nonbondedMethod, nonbondedCutoff=self.nonbondedCutoff, constraints=self.constraints, rigidWater=self.rigidWater, hydrogenMass=self.hydrogenMass, ewaldErrorTolerance=self.ewaldErrorTolerance)
-            # ewaldErrorTolerance: as "**args": Arbitrary additional keyword arguments may also be specified. This allows extra parameters to be specified that are specific to particular force fields.
+            def buildSystem():
+                forcefield = ForceField(*self.forcefieldFiles)
+                return forcefield.createSystem(self.topology, nonbondedMethod=self.nonbondedMethod, nonbondedCutoff=self.nonbondedCutoff, constraints=self.constraints, rigidWater=self.rigidWater, hydrogenMass=self.hydrogenMass, ewaldErrorTolerance=self.ewaldErrorTolerance)
+                # ewaldErrorTolerance: as "**args": Arbitrary additional keyword arguments may also be specified. This allows extra parameters to be specified that are specific to particular force fields.
+
+            self.system = self.getSystem(('explicit solvent', self.getTopologyHash(), self.forcefieldFiles), buildSystem)
 
             for atom in self.topology.atoms():
                 if atom.residue.name == 'Y' or atom.residue.name == 'TYR':
@@ -316,21 +399,43 @@ class omm:
             # TODO why looking for the TYR? covid peptide residue?
 
         else:  # create a system using prmtop file and use implicit solvent
-            self.prmtop = AmberPrmtopFile(self.structureName + '.top')  # e.g. foldedSequence_amb_processed.top or relaxedSequence_0_amb_processed.top
-            self.inpcrd = AmberInpcrdFile(self.structureName + '.crd')
-            self.topology = self.prmtop.topology
-            self.positions = self.inpcrd.positions
+            self.implicitSolventBuilder = params['implicit solvent builder']
+            if self.implicitSolventBuilder == 'openmm':  # parameterize the structure here, with the amber14 force field and the GB model's parameters
+                self.pdb = PDBFile(structure)
+                self.forcefieldFiles = ('amber14-all.xml', implicitSolventFiles[params['implicit solvent model']])
+                self.topology = self.pdb.topology
+                self.positions = self.pdb.positions
+            else:  # 'tleap': the prmtop and crd files written by tleap
+                self.prmtop = AmberPrmtopFile(self.structureName + '.top')  # e.g. foldedSequence_amb_processed.top or relaxedSequence_0_amb_processed.top
+                self.inpcrd = AmberInpcrdFile(self.structureName + '.crd')
+                self.topology = self.prmtop.topology
+                self.positions = self.inpcrd.positions
             printRecord('Creating a simulation system under implicit solvent model of {}'.format(params['implicit solvent model']))
             
             self.implicitSolventModel = params['implicit solvent model']
             self.implicitSolventSaltConc = params['implicit solvent salt conc'] * (unit.moles / unit.liter)
-            self.implicitSolventKappa = params['implicit solvent Kappa']  # add this in main_resume/main.py
+            self.implicitSolventKappa = params['implicit solvent Kappa'] / unit.angstrom if params['implicit solvent Kappa'] is not None else None  # 1/angstroms, for both builders: a bare float would be read as 1/nm
             self.soluteDielectric = params['soluteDielectric']
             self.solventDielectric = params['solventDielectric']
 
-            self.system = self.prmtop.createSystem(nonbondedMethod=self.nonbondedMethod, nonbondedCutoff=self.nonbondedCutoff, constraints=self.constraints, rigidWater=self.rigidWater,
-                                                   implicitSolvent=self.implicitSolventModel, implicitSolventSaltConc=self.implicitSolventSaltConc, implicitSolventKappa=self.implicitSolventKappa, temperature=self.temperature,
-                                                   soluteDielectric=self.soluteDielectric, solventDielectric=self.solventDielectric, removeCMMotion=True, hydrogenMass=self.hydrogenMass, ewaldErrorTolerance=self.ewaldErrorTolerance, switchDistance=0.0*unit.nanometer)
+            implicitSolventInputs = (implicitSolventFiles[self.implicitSolventModel], str(self.implicitSolventSaltConc), self.implicitSolventKappa, str(self.temperature), self.soluteDielectric, self.solventDielectric)
+            if self.implicitSolventBuilder == 'openmm':
+                def buildSystem():
+                    forcefield = ForceField(*self.forcefieldFiles)
+                    gbArgs = {'implicitSolventSaltConc': self.implicitSolventSaltConc, 'temperature': self.temperature}  # the GB force computes kappa from these, unless it is given
+                    if self.implicitSolventKappa is not None:
+                        gbArgs = {'implicitSolventKappa': self.implicitSolventKappa}
+                    return forcefield.createSystem(self.topology, nonbondedMethod=self.nonbondedMethod, nonbondedCutoff=self.nonbondedCutoff, constraints=self.constraints, rigidWater=self.rigidWater,
+                                                   soluteDielectric=self.soluteDielectric, solventDielectric=self.solventDielectric, removeCMMotion=True, hydrogenMass=self.hydrogenMass, **gbArgs)
+
+                self.system = self.getSystem(('implicit solvent openmm', self.getTopologyHash(), self.forcefieldFiles) + implicitSolventInputs, buildSystem)
+            else:
+                def buildSystem():
+                    return self.prmtop.createSystem(nonbondedMethod=self.nonbondedMethod, nonbondedCutoff=self.nonbondedCutoff, constraints=self.constraints, rigidWater=self.rigidWater,
+                                                    implicitSolvent=self.implicitSolventModel, implicitSolventSaltConc=self.implicitSolventSaltConc, implicitSolventKappa=self.implicitSolventKappa, temperature=self.temperature,
+                                                    soluteDielectric=self.soluteDielectric, solventDielectric=self.solventDielectric, removeCMMotion=True, hydrogenMass=self.hydrogenMass, ewaldErrorTolerance=self.ewaldErrorTolerance, switchDistance=0.0*unit.nanometer)
+
+                self.system = self.getSystem(('implicit solvent', getFileHash(self.structureName + '.top')) + implicitSolventInputs, buildSystem)
             '''
             temperature : 
                 Temperture of the system, only used to compute the Debye length from implicitSolventSoltConc
@@ -339,7 +444,7 @@ class omm:
                 The salt concentration for GB calculations (modelled as a debye screening parameter). 
                 It's converted to the debye length (kappa) using the provided temperature and solventDielectric
             implicitSolventKappa: 
-                float unit of 1/length: 1/angstroms. No need to * unit.xxx; 
+                params['implicit solvent Kappa'] is a float in 1/angstroms, converted to a Quantity above: OpenMM reads a bare float as 1/nm
                 If this value is set, implicitSolventSaltConc will be ignored. 
                 If not set, it's calculated as follows in OpenMM:                     
                     implicitSolventKappa = 50.33355 * sqrt(implicitSolventSaltConc / solventDielectric / temperature)
@@ -363,9 +468,11 @@ class omm:
                 If the switchDistance is 0 or evaluates to boolean False, no switching function will be used. 
                 Values greater than nonbondedCutoff or less than 0 raise ValueError
             '''
-            if self.inpcrd.boxVectors is not None:
+            if (self.implicitSolventBuilder == 'tleap') and (self.inpcrd.boxVectors is not None):
                 self.simulation.context.setPeriodicBoxVectors(*self.inpcrd.boxVectors)
 
+        self.setReporters(appendTrajectory)
+
         # Apply constraint if specified so
         if params['peptide backbone constraint constant'] != 0:
             self.force = CustomTorsionForce('0.5*K*dtheta^2; dtheta = min(diff, 2*' + str(round(pi, 3)) + '-diff); diff = abs(theta - theta0)')
@@ -440,15 +547,17 @@ class omm:
         # self.integrator = LangevinMiddleIntegrator(self.temperature, self.friction, self.dt)  # another object
         # print("Using LangevinMiddleIntegrator integrator, at T={}.".format(self.temperature))
         self.friction = params['friction'] / unit.picosecond
-        self.integrator = LangevinIntegrator(self.temperature, self.friction, self.dt)  # another object
-        printRecord("Using LangevinIntegrator integrator, at T={}.".format(self.temperature))
+        if params['integrator'] == 'LangevinMiddle':  # stable at 4 fs with hydrogen mass repartitioning
+            self.integrator = LangevinMiddleIntegrator(self.temperature, self.friction, self.dt)
+        else:
+            self.integrator = LangevinIntegrator(self.temperature, self.friction, self.dt)  # another object
+        printRecord("Using {}Integrator integrator, at T={}, time step={} fs, hydrogen mass={}.".format(params['integrator'], self.temperature, self.timeStep, self.hydrogenMass))
         
         self.integrator.setConstraintTolerance(self.constraintTolerance)  # What is this tolerance for? For constraint?
-        
-        if params['platform'] == 'CUDA':
-            self.simulation = Simulation(self.topology, self.system, self.integrator, self.platform, self.platformProperties)
-        elif params['platform'] == 'CPU':
-            self.simulation = Simulation(self.topology, self.system, self.integrator, self.platform)
+        if self.seed is not None:
+            self.integrator.setRandomNumberSeed(self.seed)
+
+        self.simulation = Simulation(self.topology, self.system, self.integrator, self.platform, self.platformProperties)
         
         if params['pick up from chk'] is False:
             self.simulation.context.setPositions(self.positions)
@@ -456,12 +565,64 @@ class omm:
         else:
             pass  # if resuming a run, the initial position comes from the chk file.        
 
+    def getSystem(self, inputs, buildSystem):
+        """
+        the System from the cache of serialized Systems, or built and added to it
+        the nonbonded, constraint and hydrogen mass parameters, and the OpenMM version, are added to the cache inputs here
+        :param inputs: everything else the System depends on: topology hash, force field, implicit solvent parameters
+        :param buildSystem: function which builds the System
+        :return:
+        """
+        if self.systemCache is None:
+            return buildSystem()
+
+        inputs = ('openmm system', Platform.getOpenMMVersion(), str(self.nonbondedMethod), str(self.nonbondedCutoff), self.ewaldErrorTolerance, str(self.constraints), self.rigidWater, str(self.hydrogenMass)) + inputs
+        serializedSystem = self.systemCache.get(inputs)
+        if serializedSystem is not None:
+            printRecord('Loaded simulation system from cache')
+            return XmlSerializer.deserialize(serializedSystem)
+
+        system = buildSystem()
+        self.systemCache.put(inputs, XmlSerializer.serialize(system))
+
+        return system
+
+    def getTopologyHash(self):
+        """
+        hash of everything in the topology a force field assigns parameters from: atoms, residues, chains, bonds and periodic box, but not positions
+        :return:
+        """
+        atoms = [(atom.residue.chain.id, atom.residue.name, atom.residue.id, atom.name, atom.element.symbol if atom.element is not None else None) for atom in self.topology.atoms()]
+        bonds = [(bond[0].index, bond[1].index) for bond in self.topology.bonds()]
+
+        return hashlib.sha256(repr((atoms, bonds, str(self.topology.getPeriodicBoxVectors()))).encode()).hexdigest()
+
+    def setReporters(self, appendTrajectory):
+        """
+        trajectory, log and checkpoint reporters of the next segment
+        :param appendTrajectory: add the frames to the end of the existing trajectory files
+        :return:
+        """
+        if self.soluteTrajectory is False:
+            self.dcdReporters = [DCDReporter(self.structureName + '_trajectory.dcd', self.reportSteps, append=appendTrajectory)]
+        else:
+            self.dcdReporters = [self.getSoluteReporter(appendTrajectory)]
+            if self.fullTrajectorySteps > 0:  # sparse trajectory with water and ions
+                self.dcdReporters.append(DCDReporter(self.structureName + '_trajectory.dcd', self.fullTrajectorySteps, append=appendTrajectory))
+        self.dataReporter = StateDataReporter(self.logFileName, self.reportSteps, totalSteps=self.steps, step=True, speed=True, progress=True, potentialEnergy=True, kineticEnergy=True, totalEnergy=True, temperature=True, volume=True, density=True, separator='\t')
+        self.checkpointReporter = CheckpointReporter(self.checkpointFile, 10000)
+
     def doMD(self):  # no need to be aware of the implicitSolvent
         '''
         automatically resume sampling if there is .chk file
+        calling it again runs a new segment, which continues the dynamics of the last one (positions and velocities in the same Context), appended to its trajectory
         '''
+        if self.segment > 0:
+            # Continue the last segment: no need to minimize, equilibrate or load a checkpoint
+            printRecord('Continuing the dynamics of segment {}'.format(self.segment))
+            self.setReporters(appendTrajectory=True)
         # if not os.path.exists(self.structureName + '_state.chk'):
-        if not self.chkFile:
+        elif not self.chkFile:
             # User did not specify a .chk file ==> we are doing a fresh sampling, not resuming.
             # Minimize and Equilibrate
             printRecord('Performing energy minimization...')
@@ -470,7 +631,10 @@ class omm:
             else:
                 self.simulation.minimizeEnergy()  # (tolerance = 1 * unit.kilojoules / unit.mole)
             printRecord('Equilibrating({} steps, time step={} fs)...'.format(self.equilibrationSteps, self.timeStep))            
-            self.simulation.context.setVelocitiesToTemperature(self.temperature)
+            if self.seed is None:
+                self.simulation.context.setVelocitiesToTemperature(self.temperature)
+            else:
+                self.simulation.context.setVelocitiesToTemperature(self.temperature, self.seed)
             self.simulation.step(self.equilibrationSteps)
         else:
             # Resume a sampling: no need to minimize and equilibrate
@@ -479,7 +643,7 @@ class omm:
 
         # Simulation
         printRecord('Simulating({} steps, time step={} fs, simTime={} ns)...'.format(self.steps, self.timeStep, self.simTime))
-        self.simulation.reporters.append(self.dcdReporter)
+        self.simulation.reporters.extend(self.dcdReporters)
         # self.simulation.reporters.append(self.pdbReporter)
         self.simulation.reporters.append(self.dataReporter)
         self.simulation.reporters.append(self.checkpointReporter)
@@ -494,10 +658,31 @@ class omm:
         else:
             self.simulation.saveCheckpoint(self.chkFile)
 
+        self.simulation.reporters.clear()  # closes the segment's trajectory and log files, eg, for the convergence analysis
+        self.dcdReporters, self.dataReporter, self.checkpointReporter = [], None, None
+        self.segment += 1
+
         self.ns_per_day = (self.steps * self.dt) / (md_time.interval * unit.seconds) / (unit.nanoseconds / unit.day)
     
         return self.ns_per_day
 
+    def getSoluteReporter(self, appendTrajectory):
+        """
+        write the aptamer (and peptide) only, to clean_<structure>_trajectory.dcd with the topology clean_<structure>.pdb
+        as cleanTrajectory does, the solute is everything but the last two chains (water and ions)
+        :param appendTrajectory:
+        :return:
+        """
+        solvent = list(self.topology.chains())[-2:]
+        soluteAtoms = np.asarray([atom.index for chain in self.topology.chains() if chain not in solvent for atom in chain.atoms()])
+        solute = Modeller(self.topology, self.positions)
+        solute.delete(solvent)
+        if (self.segment == 0) or (not os.path.exists('clean_' + self.structureName + '.pdb')):  # the solute topology of later segments is the same
+            with open('clean_' + self.structureName + '.pdb', 'w') as f:
+                PDBFile.writeFile(solute.topology, solute.positions, f, keepIds=True)
+
+        return subsetDCDReporter('clean_' + self.structureName + '_trajectory.dcd', self.reportSteps, solute.topology, soluteAtoms, append=appendTrajectory)
+
     def extractLastFrame(self, lastFrameFileName):
         lastpositions = self.simulation.context.getState(getPositions=True).getPositions()
         PDBFile.writeFile(self.topology, lastpositions, open(lastFrameFileName, 'w'))
@@ -510,6 +695,7 @@ class ld:  # lightdock
         self.runPath = params['ld run path']
         self.genPath = params['lgd generate path']
         self.clusterPath = params['lgd cluster path']
+        self.genClusterPath = params['lgd generate and cluster path']
         self.rankPath = params['lgd rank path']
         self.topPath = params['lgd top path']
 
@@ -518,6 +704,8 @@ class ld:  # lightdock
 
         self.glowWorms = 300  # params['glowworms']
         self.dockingSteps = params['docking steps']
+        self.swarmScale = params['swarm scale']
+        self.cores = params['docking cores']
         self.numTopStructures = params['N docked structures']
 
         self.pH = params['pH']
@@ -543,12 +731,10 @@ class ld:  # lightdock
         os.system('mv init ' + dir)
 
     def getSwarmCount(self):
-        # identify aptamer size
-        dimensions = getMoleculeSize(self.aptamerPDB)
-        # compute surface area of rectangular prism with no offset
-        surfaceArea = 2 * (dimensions[0] * dimensions[1] + dimensions[1] * dimensions[2] + dimensions[2] * dimensions[1])  # in angstroms
-        # compute number of swarms which cover this surface area - swarms are spheres 2 nm in diameter - this is only approximately the right number of swarms, since have no offset, and are using a rectangle
-        nSwarms = np.ceil(surfaceArea / (np.pi * 10 ** 2))
+        # solvent accessible surface area of the aptamer
+        surfaceArea = getSASA(self.aptamerPDB)  # in square angstroms
+        # number of swarms which cover this surface area - swarms are spheres 2 nm in diameter, each covering about pi * (1 nm)^2 of the surface
+        nSwarms = np.ceil(self.swarmScale * surfaceArea / (np.pi * 10 ** 2))
 
         self.swarms = int(nSwarms)  # number of glowworm swarms
 
@@ -567,12 +753,8 @@ class ld:  # lightdock
         os.system(self.runPath + ' setup.json ' + str(self.dockingSteps) + ' -s dna >> outfiles/lightdockRun.out')
 
     def generateAndCluster(self):
-        # Generate docked structures and cluster them
-        for i in range(self.swarms):
-            os.chdir('swarm_%d' % i)
-            os.system(self.genPath + ' ../' + self.aptamerPDB2 + ' ../' + self.peptidePDB2 + ' gso_%d' % self.dockingSteps + '.out' + ' %d' % self.glowWorms + ' > /dev/null 2> /dev/null; >> generate_lightdock.list')  # generate configurations
-            os.system(self.clusterPath + ' gso_%d' % self.dockingSteps + '.out >> cluster_lightdock.list')  # cluster glowworms
-            os.chdir('../')
+        # Generate docked structures and cluster them, swarms in parallel in a single LightDock process
+        os.system(self.genClusterPath + ' ' + self.aptamerPDB2 + ' ' + self.peptidePDB2 + ' %d' % self.swarms + ' %d' % self.dockingSteps + ' %d' % self.glowWorms + ' --cores %d' % self.cores + ' >> outfiles/ld_generate_cluster.out')
 
     def rank(self):
         # Rank the clustered docking setups
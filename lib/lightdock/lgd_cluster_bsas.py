@@ -3,6 +3,7 @@
 """Cluster LightDock final swarm results using BSAS algorithm"""
 
 import argparse
+import numpy as np
 from pathlib import Path
 from prody import parsePDB, confProDy, calcRMSD, matchChains
 from lightdock.util.analysis import read_lightdock_output
@@ -44,32 +45,51 @@ def get_backbone_atoms(ids_list, swarm_path):
     return ca_atoms
 
 
-def clusterize(sorted_ids, swarm_path):
-    """Clusters the structures identified by the IDS inside sorted_ids list"""
+def get_backbone_coordinates(ids_list, swarm_path):
+    """Get the backbone (CA or P) coordinates of the PDB files specified by the ids_list, as one array"""
+    backbone_atoms = get_backbone_atoms(ids_list, swarm_path)
+    return np.array([backbone_atoms[struct_id].getCoords() for struct_id in ids_list])
+
+
+def calc_rmsd_matrix(coordinates, batch_size=32):
+    """RMSD between every pair of structures, as prody.calcRMSD (no superposition), computed in batches of rows"""
+    num_structures, num_atoms = coordinates.shape[:2]
+    flat = coordinates.reshape(num_structures, -1)
+    sum_squares = np.zeros((num_structures, num_structures))
+    for start in range(0, num_structures, batch_size):
+        sum_squares[start:start + batch_size] = ((flat[start:start + batch_size, None, :] - flat[None, :, :]) ** 2).sum(axis=-1)
+    return np.sqrt(sum_squares * (1.0 / num_atoms))
+
+
+def clusterize(sorted_ids, swarm_path, backbone_coordinates=None):
+    """Clusters the structures identified by the IDS inside sorted_ids list
+
+    backbone_coordinates of all glowworms, indexed by ID, are read from the PDB files if not given
+    """
 
     clusters_found = 0
     clusters = {clusters_found: [sorted_ids[0]]}
+    representatives = [0]  # positions in sorted_ids of the cluster representatives, in cluster order
 
-    # Read all structures backbone atoms
-    backbone_atoms = get_backbone_atoms(sorted_ids, swarm_path)
+    # Read all structures backbone atoms and compare every pair at once
+    if backbone_coordinates is None:
+        coordinates = get_backbone_coordinates(sorted_ids, swarm_path)
+    else:
+        coordinates = backbone_coordinates[sorted_ids]
+    rmsd = calc_rmsd_matrix(coordinates).round(4)
 
-    for j in sorted_ids[1:]:
+    for index, j in enumerate(sorted_ids[1:], start=1):
         log.info("Glowworm %d with pdb lightdock_%d.pdb" % (j, j))
-        in_cluster = False
-        for cluster_id in list(clusters.keys()):
-            # For each cluster representative
-            representative_id = clusters[cluster_id][0]
-            rmsd = calcRMSD(backbone_atoms[representative_id], backbone_atoms[j]).round(4)
-            log.info('RMSD between %d and %d is %5.3f' % (representative_id, j, rmsd))
-            if rmsd <= 4.0:
-                clusters[cluster_id].append(j)
-                log.info("Glowworm %d goes into cluster %d" % (j, cluster_id))
-                in_cluster = True
-                break
-
-        if not in_cluster:
+        # The first cluster whose representative is close enough
+        matches = np.flatnonzero(rmsd[representatives, index] <= 4.0)
+        if len(matches) > 0:
+            cluster_id = int(matches[0])
+            clusters[cluster_id].append(j)
+            log.info("Glowworm %d goes into cluster %d" % (j, cluster_id))
+        else:
             clusters_found += 1
             clusters[clusters_found] = [j]
+            representatives.append(index)
             log.info("New cluster %d" % clusters_found)
     return clusters
 
@@ -84,14 +104,11 @@ def write_cluster_info(clusters, gso_data, swarm_path):
         log.info(f"Cluster result written to {file_name} file")
 
 
-if __name__ == '__main__':
-
+def cluster_swarm(gso_output_file, backbone_coordinates=None):
+    """Clusters the glowworms of a swarm and writes the cluster representatives file next to the LightDock output file"""
     try:
-        # Parse command line
-        args = parse_command_line()
-
         # Read LightDock output data
-        gso_data = read_lightdock_output(args.gso_output_file)
+        gso_data = read_lightdock_output(gso_output_file)
 
         # Sort the glowworms data by scoring
         sorted_data = sorted(gso_data, key=lambda k: k.scoring, reverse=True)
@@ -100,8 +117,8 @@ if __name__ == '__main__':
         sorted_ids = [g.id_glowworm for g in sorted_data]
 
         # Calculate the different clusters
-        swarm_path = Path(args.gso_output_file).absolute().parent
-        clusters = clusterize(sorted_ids, swarm_path)
+        swarm_path = Path(gso_output_file).absolute().parent
+        clusters = clusterize(sorted_ids, swarm_path, backbone_coordinates)
 
         # Write clustering information
         write_cluster_info(clusters, gso_data, swarm_path)
@@ -109,3 +126,11 @@ if __name__ == '__main__':
     except Exception as e:
         log.error('Clustering has failed. Please see error:')
         log.error(str(e))
+
+
+if __name__ == '__main__':
+
+    # Parse command line
+    args = parse_command_line()
+
+    cluster_swarm(args.gso_output_file)
@@ -0,0 +1,87 @@
+#!/home/mkilgour/miniconda3/bin/python
+
+"""Generates the structures of every swarm and clusters them, with the swarms running in parallel
+
+Same clusters as running lgd_generate_conformations.py and lgd_cluster_bsas.py in each swarm directory,
+but LightDock is imported and the receptor and ligand are parsed only once, then shared with Ant-Thony's workers.
+The structures are clustered in memory: no lightdock_<id>.pdb files are written, lgd_top.py writes the top ones.
+"""
+
+import os
+import sys
+import argparse
+from contextlib import contextmanager
+from ant_thony import Ant_Thony
+from lgd_generate_conformations import read_structures, generate_backbone_coordinates
+from lgd_cluster_bsas import cluster_swarm
+from lightdock.util.logger import LoggingManager
+from lightdock.util.parser import valid_file, valid_integer_number
+
+
+log = LoggingManager.get_logger('lgd_generate_and_cluster')
+
+
+@contextmanager
+def redirect_output(file_name, streams=(1, 2)):
+    """Sends the output of the given file descriptors to a file, like a shell redirection"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(fd) for fd in streams]
+    with open(file_name, 'a') as handle:
+        for fd in streams:
+            os.dup2(handle.fileno(), fd)
+        try:
+            yield
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip(streams, saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+
+
+class SwarmTask:
+    """Generates and clusters the conformations of one swarm"""
+    def __init__(self, path, receptor, ligand, receptor_structures, gso_output, glowworms):
+        self.path = path
+        self.receptor = receptor
+        self.ligand = ligand
+        self.receptor_structures = receptor_structures
+        self.gso_output = gso_output
+        self.glowworms = glowworms
+
+    def run(self):
+        os.chdir(self.path)
+        with redirect_output(os.devnull):
+            backbone_coordinates = generate_backbone_coordinates(self.receptor, self.ligand, self.receptor_structures,
+                                                                 self.gso_output, self.glowworms)
+        with redirect_output('cluster_lightdock.list', streams=(1,)):
+            cluster_swarm(self.gso_output, backbone_coordinates)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="lgd_generate_and_cluster")
+    parser.add_argument("receptor_structures", help="receptor structures: PDB file or list of PDB files",
+                        type=valid_file, metavar="receptor_structure")
+    parser.add_argument("ligand_structures", help="ligand structures: PDB file or list of PDB files",
+                        type=valid_file, metavar="ligand_structure")
+    parser.add_argument("swarms", help="number of swarms", type=valid_integer_number)
+    parser.add_argument("steps", help="number of docking steps", type=valid_integer_number)
+    parser.add_argument("glowworms", help="number of glowworms", type=valid_integer_number)
+    parser.add_argument("--cores", "-cores", "-c", help="CPU cores to use", dest="cores", type=int, default=0)
+
+    args = parser.parse_args()
+
+    receptor = read_structures(args.receptor_structures, 'receptor')
+    ligand = read_structures(args.ligand_structures, 'ligand')
+
+    # normal modes are looked up next to the receptor file
+    receptor_structures = os.path.abspath(args.receptor_structures)
+    tasks = [SwarmTask(os.path.abspath('swarm_%d' % i), receptor, ligand, receptor_structures,
+                       'gso_%d.out' % args.steps, args.glowworms) for i in range(args.swarms)]
+
+    anthony = Ant_Thony(tasks, args.cores)
+    anthony.release()
+    anthony.go_home()
+    log.info("Generated and clustered %d swarms" % args.swarms)
@@ -52,72 +52,43 @@ def parse_output_file(lightdock_output, num_anm_rec, num_anm_lig):
     return translations, rotations, receptor_ids, ligand_ids, rec_extents, lig_extents
 
 
-if __name__ == "__main__":
-
-    parser = argparse.ArgumentParser(prog="conformer_conformations")
-    # Receptor
-    parser.add_argument("receptor_structures", help="receptor structures: PDB file or list of PDB files",
-                        type=valid_file, metavar="receptor_structure")
-    # Ligand
-    parser.add_argument("ligand_structures", help="ligand structures: PDB file or list of PDB files",
-                        type=valid_file, metavar="ligand_structure")
-    # Lightdock output file
-    parser.add_argument("lightdock_output", help="lightdock output file",
-                        type=valid_file, metavar="lightdock_output")
-    # Number of glowworms
-    parser.add_argument("glowworms", help="number of glowworms", type=valid_integer_number)
-    # Optional, setup file
-    parser.add_argument("--setup", "-setup", "-s", help="Simulation setup file",
-                            dest="setup_file", metavar="setup_file", type=valid_file, 
-                            default=None)
+def read_structures(structures_file, kind):
+    """Reads a receptor or ligand: a PDB file or list of PDB files"""
+    structures = []
+    for structure in get_lightdock_structures(structures_file):
+        log.info("Reading %s %s PDB file..." % (structure, kind))
+        atoms, residues, chains = parse_complex_from_file(structure)
+        structures.append({'atoms': atoms, 'residues': residues, 'chains': chains, 'file_name': structure})
+        log.info("%s atoms, %s residues read." % (len(atoms), len(residues)))
+    return Complex.from_structures(structures)
 
-    args = parser.parse_args()
 
-    # Load setup configuration if provided
-    setup = get_setup_from_file(args.setup_file) if args.setup_file else None
+def generate_poses(receptor, ligand, receptor_structures, lightdock_output, glowworms, setup=None):
+    """Yields the receptor and ligand poses of the glowworms in a LightDock output file
 
+    receptor_structures is the path of the receptor file, next to which normal modes are looked up
+    """
     num_anm_rec = DEFAULT_NMODES_REC
     num_anm_lig = DEFAULT_NMODES_LIG
     if setup and setup['use_anm']:
         num_anm_rec = setup['anm_rec']
         num_anm_lig = setup['anm_lig']
 
-    # Receptor
-    structures = []
-    for structure in get_lightdock_structures(args.receptor_structures):
-        log.info("Reading %s receptor PDB file..." % structure)
-        atoms, residues, chains = parse_complex_from_file(structure)
-        structures.append({'atoms': atoms, 'residues': residues, 'chains': chains, 'file_name': structure})
-        log.info("%s atoms, %s residues read." % (len(atoms), len(residues)))
-    receptor = Complex.from_structures(structures)
-
-    # Ligand
-    structures = []
-    for structure in get_lightdock_structures(args.ligand_structures):
-        log.info("Reading %s ligand PDB file..." % structure)
-        atoms, residues, chains = parse_complex_from_file(structure)
-        structures.append({'atoms': atoms, 'residues': residues, 'chains': chains, 'file_name': structure})
-        log.info("%s atoms, %s residues read." % (len(atoms), len(residues)))
-    ligand = Complex.from_structures(structures)
-
     # Output file
     translations, rotations, receptor_ids, ligand_ids, \
-        rec_extents, lig_extents = parse_output_file(args.lightdock_output, num_anm_rec, num_anm_lig)
+        rec_extents, lig_extents = parse_output_file(lightdock_output, num_anm_rec, num_anm_lig)
 
     found_conformations = len(translations)
-    num_conformations = args.glowworms
+    num_conformations = glowworms
     if num_conformations > found_conformations:
         log.warning("Number of conformations is bigger than found solutions (%s > %s)" % (num_conformations,
                                                                                           found_conformations))
         log.warning("Clipping number of conformations to %s" % found_conformations)
         num_conformations = found_conformations
 
-    # Destination path is the same as the lightdock output
-    destination_path = os.path.dirname(args.lightdock_output)
-
     # If normal modes used, need to read them
     nmodes_rec = nmodes_lig = None
-    nm_path = os.path.abspath(os.path.dirname(args.receptor_structures))
+    nm_path = os.path.abspath(os.path.dirname(receptor_structures))
     # Check NM file for receptor
     nm_rec_file = os.path.join(nm_path, DEFAULT_REC_NM_FILE + '.npy')
     if os.path.exists(nm_rec_file):
@@ -163,6 +134,61 @@ if __name__ == "__main__":
         ligand_pose.rotate(rotations[i])
         ligand_pose.translate(translations[i])
 
+        yield receptor_pose, ligand_pose
+    log.info("Generated %d conformations" % num_conformations)
+
+
+def generate_conformations(receptor, ligand, receptor_structures, lightdock_output, glowworms, setup=None):
+    """Writes the PDB structures of the glowworms in a LightDock output file"""
+    # Destination path is the same as the lightdock output
+    destination_path = os.path.dirname(lightdock_output)
+
+    for i, (receptor_pose, ligand_pose) in enumerate(generate_poses(receptor, ligand, receptor_structures,
+                                                                    lightdock_output, glowworms, setup)):
         write_pdb_to_file(receptor, os.path.join(destination_path, 'lightdock_%s.pdb' % i), receptor_pose)
         write_pdb_to_file(ligand,  os.path.join(destination_path, 'lightdock_%s.pdb' % i), ligand_pose)
-    log.info("Generated %d conformations" % num_conformations)
+
+
+def generate_backbone_coordinates(receptor, ligand, receptor_structures, lightdock_output, glowworms, setup=None):
+    """Backbone (CA or P) coordinates of the glowworms in a LightDock output file, without writing any PDB file
+
+    Same values as read back from the lightdock_<id>.pdb files, which only keep three decimals
+    """
+    receptor_backbone = [atom.index for atom in receptor.atoms if atom.name in ('CA', 'P')]
+    ligand_backbone = [atom.index for atom in ligand.atoms if atom.name in ('CA', 'P')]
+
+    coordinates = np.array([np.concatenate((receptor_pose.coordinates[receptor_backbone],
+                                            ligand_pose.coordinates[ligand_backbone]))
+                            for receptor_pose, ligand_pose in generate_poses(receptor, ligand, receptor_structures,
+                                                                             lightdock_output, glowworms, setup)])
+    return np.char.mod('%.3f', coordinates).astype(float)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(prog="conformer_conformations")
+    # Receptor
+    parser.add_argument("receptor_structures", help="receptor structures: PDB file or list of PDB files",
+                        type=valid_file, metavar="receptor_structure")
+    # Ligand
+    parser.add_argument("ligand_structures", help="ligand structures: PDB file or list of PDB files",
+                        type=valid_file, metavar="ligand_structure")
+    # Lightdock output file
+    parser.add_argument("lightdock_output", help="lightdock output file",
+                        type=valid_file, metavar="lightdock_output")
+    # Number of glowworms
+    parser.add_argument("glowworms", help="number of glowworms", type=valid_integer_number)
+    # Optional, setup file
+    parser.add_argument("--setup", "-setup", "-s", help="Simulation setup file",
+                            dest="setup_file", metavar="setup_file", type=valid_file, 
+                            default=None)
+
+    args = parser.parse_args()
+
+    # Load setup configuration if provided
+    setup = get_setup_from_file(args.setup_file) if args.setup_file else None
+
+    receptor = read_structures(args.receptor_structures, 'receptor')
+    ligand = read_structures(args.ligand_structures, 'ligand')
+
+    generate_conformations(receptor, ligand, args.receptor_structures, args.lightdock_output, args.glowworms, setup)
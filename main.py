@@ -23,7 +23,7 @@ if params['device'] == 'cluster':
     params['sequence'] = cmdLineInputs[1]  # DNA aptamer sequence
     params['peptide'] = cmdLineInputs[2]   # target peptide sequence
     params['max walltime'] = cmdLineInputs[3]  # maximum walltime in hours
-                                               # After free aptamer MD, "sampling time" might be reduced to ensure bindingDynamics to finish before time out.
+                                               # Each MD run's segments may be shorter than "sampling time", so that the remaining runs fit, at the measured throughput of MD, docking and analysis.
                                                # Or give up if this isn't enough time to complete even a minimum run.
     # Physical params
     params['temperature'] = cmdLineInputs[4]     # Kevin - used to predict secondary structure and for MD thermostat
@@ -66,6 +66,7 @@ if params['skip MMB'] is True:
 params['mode'] = 'free aptamer'  # 'full binding'  # 'full docking'  #'smooth dock'  #'coarse dock'  #'free aptamer'  # '3d smooth' # 'full binding'  # specify what to do
 params['test mode'] = False
 params['explicit run enumeration'] = True  # To resume a previous run from .chk file, use "False" here
+params['resume stages'] = False  # if True, rerun in the existing directory of 'run num' (not 0), skipping every stage completed with the same inputs, as recorded in its stageManifest.json
 
 # Pipeline parameters
 params['secondary structure engine'] = 'NUPACK'  # 'NUPACK' or 'seqfold' - NUPACK has many more features and is the only package set up for probability analysis
@@ -80,9 +81,17 @@ params['time step'] = 2.0  # MD time step in fs
 params['print step'] = 10 # MD printout step in ps. ns > ps > fs
 params['max aptamer sampling iterations'] = 20   # number of allowable iterations before giving on auto-sampling - total max simulation length = this * sampling time
 params['max complex sampling iterations'] = 5  # number of iterations for the binding complex
+params['representative structure mode'] = 'density'  # 'density': frame with the most neighbours in PC space, memory scales with frames; 'histogram': maximum of a smoothed multidimensional histogram, memory scales with bins^PCs
 params['autoMD convergence cutoff'] = 1e-2  # how small should average of PCA slopes be to count as 'converged' # TODO: where is the PCA used? to cluster conformations to obtain a representive one? # TODO: another clustering methods
+params['replicas'] = 1  # if > 1, the free aptamer sampling is split between this many independently seeded simulations, run in parallel. Their trajectories are analyzed together
+params['replica threads'] = 1  # CPU threads for each replica on the 'CPU' platform. On 'CUDA', replicas share the device
+params['random seed'] = 1  # seeds of the replicas are drawn from it, and saved with the free aptamer results. None: different seeds for every run
 params['docking steps'] = 200  # number of steps for docking simulations
+params['swarm scale'] = 1  # number of swarms, relative to the number needed to cover the aptamer's solvent accessible surface. See lightdockConvergenceTest.py for the cost/quality trade-off
+params['docking cores'] = 0  # CPU cores for generating and clustering docked structures, one swarm per core at a time. 0: all available cores
 params['N docked structures'] = 1  # 2 # number of docked structures to output from the docker. If running binding, it will go this time (at linear cost) # TODO: "it will go this time"?
+params['parallel branches'] = False  # if True, each 2D structure branch (and each docked structure's binding run) is an independent task in a process pool, each in its own sub-directory of the workdir
+params['branch workers'] = 2  # number of parallel tasks when 'parallel branches' is True. On a single GPU, all tasks share the device
 
 if params['test mode']:  # shortcut for debugging
     params['N 2D structures'] = 1  # the clustering algorithm will stop when there are two structures left???
@@ -126,6 +135,8 @@ else:
 params['force field'] = 'AMBER'  # this does nothing. The force field is specified in __init__ of interfaces.py
 params['water model'] = 'tip3p'  # 'tip3p' (runs on Amber 14), other explicit models are also easy to add
 params['box offset'] = 1.0  # nanometers
+params['solute trajectory'] = True  # write only the aptamer (and peptide) to the trajectory during MD, rather than removing water and ions from the full trajectory afterwards
+params['full trajectory print step'] = 0  # ps. With 'solute trajectory', also write a sparse trajectory of the full system (eg, for visualizing the solvent) every this many ps. 0 to not write one
 
 params['barostat interval'] = 25  # NOT USED.
 params['friction'] = 1.0  # 1/picoseconds: friction coefficient determines how strongly the system is coupled to the heat bath (OpenMM)
@@ -138,6 +149,12 @@ params['constraints'] = HBonds
 params['rigid water'] = True  # By default, OpenMM makes water molecules completely rigid, constraining both their bond lengths and angles. If False, it's good to reduce integration step size to 0.5 fs
 params['constraint tolerance'] = 1e-6  # What is this tolerance for? For constraint?
 params['hydrogen mass'] = 1.5  # in a.m.u. - we can increase the sampling time if we use heavier hydrogen
+params['integrator'] = 'Langevin'  # 'Langevin': LangevinIntegrator; 'LangevinMiddle': LangevinMiddleIntegrator, more accurate sampling at large time steps
+params['hmr mode'] = False  # performance mode: full hydrogen mass repartitioning with a 4 fs time step, ie, half the steps per ns. Validate against the 2 fs baseline with hmrBenchmark.py
+if params['hmr mode']:
+    params['hydrogen mass'] = 4.0
+    params['integrator'] = 'LangevinMiddle'
+    params['time step'] = 4.0
 params['peptide backbone constraint constant'] = 0  # 10000  # constraint on the peptide's dihedral angles. force constant k.
 
 # Specify implicit solvent model
@@ -164,6 +181,7 @@ if params['implicit solvent']:
         But can still specify cutoff for electrostatic interactions => params['nonbonded cutoff'] still works
         More on PBC: Periodic boundary conditions are used to avoid surface effects in explicit solvent simulations. Since implicit solvent simulations do not have solvent boundaries (the continuum goes on forever), 
         there is rarely a reason to use periodic boundary conditions in implicit solvent simulations.'''
+    params['implicit solvent builder'] = 'tleap'  # 'tleap': AmberTools tleap with the leap template (.top and .crd cached with params['system cache']); 'openmm': prepare the structure with PDBFixer (as prepPDB, without water) and parameterize it in process with the amber14 force field and the GB model's implicit/*.xml
     params['leap template'] = 'leap_template.in'
     params['implicit solvent salt conc'] = params['ionicStrength']  # molar/unit. Salt conc in solvent: converted to debye length (kappa) using the provided temperature and solventDielectric (see interfaces.py for detailed walk-through)
                                                     # need to be user input
@@ -183,6 +201,7 @@ if params['device'] == 'local':
     params['ld run path'] = 'ld_scripts/lightdock3.py'
     params['lgd generate path'] = '../ld_scripts/lgd_generate_conformations.py'
     params['lgd cluster path'] = '../ld_scripts/lgd_cluster_bsas.py'
+    params['lgd generate and cluster path'] = 'ld_scripts/lgd_generate_and_cluster.py'  # both of the above, all swarms in parallel
     params['lg ant path'] = 'ld_scripts/ant_thony.py'
     params['lgd rank path'] = 'ld_scripts/lgd_rank.py'
     params['lgd top path'] = 'ld_scripts/lgd_top.py'
@@ -200,10 +219,21 @@ elif params['device'] == 'cluster':
     params['ld run path'] = 'python ld_scripts/lightdock3.py'
     params['lgd generate path'] = 'python ../ld_scripts/lgd_generate_conformations.py'
     params['lgd cluster path'] = 'python ../ld_scripts/lgd_cluster_bsas.py'
+    params['lgd generate and cluster path'] = 'python ld_scripts/lgd_generate_and_cluster.py'  # both of the above, all swarms in parallel
     params['lg ant path'] = 'python ld_scripts/ant_thony.py'  # ant? thony?
     params['lgd rank path'] = 'python ld_scripts/lgd_rank.py'
     params['lgd top path'] = 'python ld_scripts/lgd_top.py'
 
+# Result cache: shared between runs in the same workdir (and between cluster jobs)
+params['cache dir'] = params['workdir'] + '/cache'
+params['cache size'] = 1024  # MB - least recently used results are evicted beyond this size
+params['nupack cache'] = True  # reuse NUPACK 2D analyses of the same sequence at the same temperature, [Na] and [Mg]
+params['fold cache'] = True  # reuse MMB folds of the same 2D structure
+params['free aptamer cache'] = True  # reuse the folded, smoothed and sampled free aptamer for the same 2D structure and MD parameters (stores its trajectory, mind the cache size)
+params['system cache'] = True  # reuse OpenMM Systems (serialized) built from the same topology, force field and nonbonded/constraint/implicit solvent parameters
+params['save outputs'] = True  # save results to opendnaOutput.npy in the run directory. screen.py collects them in one table instead
+params['feature store'] = True  # keep the per-frame features of analyzed trajectories in the run's featureStore directory, so each frame is only analyzed once
+
 # MMB control files
 params['mmb params'] = 'lib/mmb/parameters.csv'
 params['mmb normal template'] = 'lib/mmb/commands.template.dat'
@@ -6,8 +6,12 @@ import numpy as np
 import MDAnalysis as mda
 """
 import sys
+import copy
 import glob
+import hashlib
+import multiprocessing
 from shutil import copyfile, copytree
+from concurrent.futures import ProcessPoolExecutor
 
 import interfaces
 from utils import *
@@ -27,17 +31,28 @@ Done:
 
 
 class opendna:
-    def __init__(self, params):
+    def __init__(self, params, workDir=None):
+        """
+        :param params:
+        :param workDir: working directory of an existing run, for the pipeline of a parallel task (see getTaskPipeline): no setup
+        """
         self.workDir = ""  # rather use an empty string, not an empty list
         self.params = params
         self.sequence = self.params['sequence']
         self.peptide = self.params['peptide']
         self.pdbDict = {}
         self.dcdDict = {}  # output file format is .dcd???
+        self.featureStore = None  # per-run store of trajectory features, see setup
+        self.scheduler = walltimeScheduler(self.params['max walltime'])  # measured throughput of the stages, to fit the MD sampling into the walltime
+        self.num2dStructures = 1  # number of 2D structure branches, set in run
 
         self.actionDict = {}
         self.getActionDict()  # specify the actions based on the selected mode
-        if self.actionDict['make workdir']:
+        if workDir is not None:
+            self.workDir = workDir
+            if self.params['feature store'] is True:
+                self.featureStore = featureStore(self.workDir + '/featureStore')
+        elif self.actionDict['make workdir']:
             self.setup()  # if we don't need a workdir & MMB files (eg, give a 3D structure), don't make one.
 
         self.i = int(-1)
@@ -145,12 +160,12 @@ class opendna:
                 self.makeNewWorkingDirectory()
             else:  # create a working directory defined by the user
                 self.workDir = self.params['workdir'] + '/run%d' % self.params['run num']
-                os.mkdir(self.workDir)
+                os.makedirs(self.workDir, exist_ok=self.params['resume stages'])  # resume a run in its existing directory
         else:
             self.workDir = self.params['workdir'] + '/' + 'run%d' % self.params['run num']
 
         # copy relevant files to the workDir
-        os.mkdir(self.workDir + '/outfiles')
+        os.makedirs(self.workDir + '/outfiles', exist_ok=self.params['resume stages'])
         if self.params['implicit solvent'] is True:
             copyfile(self.params['leap template'], self.workDir + '/leap_template.in')
         # copy structure files
@@ -191,7 +206,7 @@ class opendna:
 
         # copy lightdock scripts
         if self.actionDict['do docking'] is True:
-            copytree('lib/lightdock', self.workDir + '/ld_scripts')  # if destination dir does not already exist, create one then copy the whole source dir
+            copytree('lib/lightdock', self.workDir + '/ld_scripts', dirs_exist_ok=self.params['resume stages'])  # if destination dir does not already exist, create one then copy the whole source dir
 
         # copy csv file (dihedral restraints) if restraints are turned on
         if self.params['peptide backbone constraint constant'] != 0:
@@ -199,6 +214,8 @@ class opendna:
 
         # move to working dir
         os.chdir(self.workDir)
+        if self.params['feature store'] is True:
+            self.featureStore = featureStore(self.workDir + '/featureStore')
         if self.peptide == 'A':
             printRecord('Simulating free aptamer: {}'.format(self.sequence))
         else:
@@ -243,12 +260,13 @@ class opendna:
         # outputDict = {'params': self.params}
         outputDict = {}
         outputDict['params'] = self.params
-        np.save('opendnaOutput', outputDict)  # Save an array to a binary file in NumPy ``.npy`` format.
+        self.saveOutputs(outputDict)
 
         if self.actionDict['do 2d analysis']:   # get secondary structure
-            self.pairLists = self.getSecondaryStructure(self.sequence)
+            ssInputs = (self.sequence, self.params['secondary structure engine'], self.params['temperature'], self.params['ionicStrength'], self.params['[Mg]'], self.params['N 2D structures'])
+            self.pairLists = self.runStage('2d analysis', ssInputs, self.getSecondaryStructure, self.sequence)
             outputDict['2d analysis'] = self.ssAnalysis
-            np.save('opendnaOutput', outputDict)  # save 2d structure results
+            self.saveOutputs(outputDict)  # save 2d structure results
 
             printRecord('Running over %d' % len(self.pairLists) + ' possible 2D structures')
             num_2dSS = len(self.pairLists)
@@ -261,56 +279,205 @@ class opendna:
             printRecord('Starting with an existing folded strcuture.')
             num_2dSS = 1  # quick and dirty
 
-        for self.i in range(num_2dSS):  # loop over all possible secondary structures
-            
-            if self.actionDict['do 2d analysis'] is True:  # self.ssAnalysis only exists if we "do 2d analysis"
-                printRecord('2D structure #{} is                             : {}'.format(self.i, self.ssAnalysis['2d string'][self.i]))
-                self.pairList = np.asarray(self.pairLists[self.i])  # be careful!!!: .pairList vs. .pairLists
-
-            if self.actionDict['do MMB']:  # fold 2D into 3D
-                self.foldSequence(self.sequence, self.pairList)
-            elif self.params['pick up from chk'] is False:  # start with a folded initial structure: skipped MMB but will do MD smooth
-                self.pdbDict['folded sequence {}'.format(self.i)] = self.params['folded initial structure']
-                self.pdbDict['representative aptamer {}'.format(self.i)] = self.params['folded initial structure']  # in "coarse dock" mode.
-
-            if self.actionDict['do smoothing']:
-                if self.params['skip MMB'] is False:
-                    self.MDSmoothing(self.pdbDict['mmb folded sequence {}'.format(self.i)], relaxationTime=self.params['smoothing time'], implicitSolvent=self.params['implicit solvent'])  # relax for xx nanoseconds
-                else:
-                    self.MDSmoothing(self.pdbDict['folded sequence {}'.format(self.i)], relaxationTime=self.params['smoothing time'], implicitSolvent=self.params['implicit solvent'])  # relax for xx nanoseconds
-
-            if self.actionDict['get equil repStructure']:  # definitely did smoothing if want an equil structure                    
-                if self.params['pick up from chk'] is False:
-                    outputDict['free aptamer results {}'.format(self.i)] = self.runFreeAptamer(self.pdbDict['relaxed sequence {}'.format(self.i)], implicitSolvent=self.params['implicit solvent'])
-                else:
-                    outputDict['free aptamer results {}'.format(self.i)] = self.runFreeAptamer(self.params['resumed structurePDB'], implicitSolvent=self.params['implicit solvent'])  # quick and dirty. Eg, 'relaxedSequence_0_processed.pdb'
-                    # if using implicit solvent, the .top and .crd files have the same name as .pdb. For ex: relaxed_amb_processed.pdb/top/crd
-
-                np.save('opendnaOutput', outputDict)  # save outputs
-
-            if self.actionDict['do docking'] and (self.peptide is not False):  # find docking configuration for the complexed structure
-                # coarse dock: no smoothing;
-                # smooth dock: smooth + dock
-                # full dock: smooth + dock + equil structure
-                # full binding: smooth + dock + equil structure + sampling dynamics
-                outputDict['dock scores {}'.format(self.i)] = self.dock(self.pdbDict['representative aptamer {}'.format(self.i)], 'peptide.pdb')
-                # pdbDict['representative aptamer {}' is defined at MMb folding, MD smoothing and runFreeAptamer
-                # TODO: does lightdock also support Amber implicit solvent model?
-                np.save('opendnaOutput', outputDict)  # save outputs
-
-            # N docked structures are specified by user: how many docked structures do we want to investigate
-            printRecord('Running over %d' % self.params['N docked structures'] + ' docked structures')
-
-            for self.j in range(self.params['N docked structures']):  # loop over docking configurations for a given secondary structure
-                printRecord('Docked structure #{}'.format(self.j))
-                if self.actionDict['do binding']:  # run MD on the complexed structure
-                    outputDict['binding results {} {}'.format(self.i, self.j)] = self.bindingDynamics(self.pdbDict['binding complex {} {}'.format(self.i, int(self.j))], implicitSolvent=self.params['implicit solvent'])
-                    # TODO why need int(self.j)? Why sometimes %d % string, but sometimes {}.format?
-
-                    np.save('opendnaOutput', outputDict)
+        self.num2dStructures = num_2dSS  # the scheduler shares the walltime between the remaining branches
+        try:
+            if self.params['parallel branches'] is True:  # every 2D structure and docked structure is an independent task
+                self.runParallelBranches(num_2dSS, outputDict)
+            else:
+                for self.i in range(num_2dSS):  # loop over all possible secondary structures
+                    self.runBranch(outputDict)
+
+                    # N docked structures are specified by user: how many docked structures do we want to investigate
+                    printRecord('Running over %d' % self.params['N docked structures'] + ' docked structures')
+
+                    for self.j in range(self.params['N docked structures']):  # loop over docking configurations for a given secondary structure
+                        self.runBinding(outputDict)
+        except walltimeExceeded as error:  # keep what was completed so far
+            printRecord(str(error))
+            self.saveOutputs(outputDict)
+            self.terminateRun()
 
         return outputDict
 
+    def runBranch(self, outputDict):
+        """
+        run every stage up to docking for the 2D structure #self.i
+        :param outputDict:
+        :return:
+        """
+        if self.actionDict['do 2d analysis'] is True:  # self.ssAnalysis only exists if we "do 2d analysis"
+            printRecord('2D structure #{} is                             : {}'.format(self.i, self.ssAnalysis['2d string'][self.i]))
+            self.pairList = np.asarray(self.pairLists[self.i])  # be careful!!!: .pairList vs. .pairLists
+
+        if not self.loadCachedFreeAptamer(outputDict):  # unless the same free aptamer was already sampled by a previous run
+            self.prepareAptamer(outputDict)
+            self.cacheFreeAptamer(outputDict)
+
+        if self.actionDict['do docking'] and (self.peptide is not False):  # find docking configuration for the complexed structure
+            # coarse dock: no smoothing;
+            # smooth dock: smooth + dock
+            # full dock: smooth + dock + equil structure
+            # full binding: smooth + dock + equil structure + sampling dynamics
+            aptamer = self.pdbDict['representative aptamer {}'.format(self.i)]
+            dockInputs = (getFileHash(aptamer), self.peptide, self.params['docking steps'], self.params['swarm scale'], self.params['N docked structures'], self.params['pH'], self.params['peptide backbone constraint constant'])
+            outputDict['dock scores {}'.format(self.i)] = self.runStage('docking {}'.format(self.i), dockInputs, self.dock, aptamer, 'peptide.pdb')
+            # pdbDict['representative aptamer {}' is defined at MMb folding, MD smoothing and runFreeAptamer
+            # TODO: does lightdock also support Amber implicit solvent model?
+            self.saveOutputs(outputDict)  # save outputs
+
+    def prepareAptamer(self, outputDict):
+        """
+        fold, smooth and sample the free aptamer for the 2D structure #self.i, as set in actionDict
+        :param outputDict:
+        :return:
+        """
+        if self.actionDict['do MMB']:  # fold 2D into 3D
+            foldInputs = (self.sequence, np.asarray(self.pairList).tolist(), self.params['fold speed'], self.params['foldFidelity'], self.params['temperature'], self.getMMBTemplateHashes())
+            self.runStage('fold {}'.format(self.i), foldInputs, self.foldSequence, self.sequence, self.pairList)
+        elif self.params['pick up from chk'] is False:  # start with a folded initial structure: skipped MMB but will do MD smooth
+            self.pdbDict['folded sequence {}'.format(self.i)] = self.params['folded initial structure']
+            self.pdbDict['representative aptamer {}'.format(self.i)] = self.params['folded initial structure']  # in "coarse dock" mode.
+
+        if self.actionDict['do smoothing']:
+            if self.params['skip MMB'] is False:
+                foldedStructure = self.pdbDict['mmb folded sequence {}'.format(self.i)]
+            else:
+                foldedStructure = self.pdbDict['folded sequence {}'.format(self.i)]
+            self.runStage('smoothing {}'.format(self.i), (getFileHash(foldedStructure), self.getMDParams()),
+                          self.MDSmoothing, foldedStructure, relaxationTime=self.params['smoothing time'], implicitSolvent=self.params['implicit solvent'])  # relax for xx nanoseconds
+
+        if self.actionDict['get equil repStructure']:  # definitely did smoothing if want an equil structure
+            if self.params['pick up from chk'] is False:
+                relaxedStructure = self.pdbDict['relaxed sequence {}'.format(self.i)]
+                outputDict['free aptamer results {}'.format(self.i)] = self.runStage('free aptamer {}'.format(self.i), (getFileHash(relaxedStructure), self.getMDParams()),
+                                                                                     self.runFreeAptamer, relaxedStructure, implicitSolvent=self.params['implicit solvent'])
+            else:
+                outputDict['free aptamer results {}'.format(self.i)] = self.runFreeAptamer(self.params['resumed structurePDB'], implicitSolvent=self.params['implicit solvent'])  # quick and dirty. Eg, 'relaxedSequence_0_processed.pdb'
+                # if using implicit solvent, the .top and .crd files have the same name as .pdb. For ex: relaxed_amb_processed.pdb/top/crd
+
+            self.saveOutputs(outputDict)  # save outputs
+
+    def runBinding(self, outputDict):
+        """
+        run the binding dynamics for the docked structure #self.j of the 2D structure #self.i
+        :param outputDict:
+        :return:
+        """
+        printRecord('Docked structure #{}'.format(self.j))
+        if self.actionDict['do binding']:  # run MD on the complexed structure
+            complex = self.pdbDict['binding complex {} {}'.format(self.i, int(self.j))]
+            bindingInputs = (getFileHash(complex), getFileHash(self.pdbDict['sampled aptamer {}'.format(self.i)]), getFileHash(self.dcdDict['sampled aptamer {}'.format(self.i)]),
+                             self.getMDParams(), self.params['max complex sampling iterations'], self.params['peptide backbone constraint constant'])
+            outputDict['binding results {} {}'.format(self.i, self.j)] = self.runStage('binding {} {}'.format(self.i, self.j), bindingInputs,
+                                                                                      self.bindingDynamics, complex, implicitSolvent=self.params['implicit solvent'])
+            # TODO why need int(self.j)? Why sometimes %d % string, but sometimes {}.format?
+
+            self.saveOutputs(outputDict)
+
+    def runParallelBranches(self, num_2dSS, outputDict):
+        """
+        run each 2D structure branch, then each binding run of its docked structures, as independent tasks in a process pool
+        each task works in its own sub-directory, and its results are merged back into outputDict
+        :param num_2dSS:
+        :param outputDict:
+        :return:
+        """
+        printRecord('Running {} 2D structure branches on {} parallel workers'.format(num_2dSS, self.params['branch workers']))
+        with ProcessPoolExecutor(max_workers=self.params['branch workers']) as pool:
+            tasks = []
+            taskInputs = self.getTaskInputs()
+            for i in range(num_2dSS):
+                branchDir = self.setupBranchDirectory('branch_{}'.format(i))
+                tasks.append(pool.submit(runBranchTask, taskInputs, i, branchDir))
+            self.mergeTasks(tasks, outputDict)
+
+            if self.actionDict['do binding']:
+                printRecord('Running over %d' % self.params['N docked structures'] + ' docked structures')
+                tasks = []
+                taskInputs = self.getTaskInputs()  # with the merged outputs of the branch tasks
+                for i in range(num_2dSS):
+                    for j in range(self.params['N docked structures']):
+                        bindingDir = self.setupBranchDirectory('branch_{}/binding_{}'.format(i, j))
+                        tasks.append(pool.submit(runBindingTask, taskInputs, i, j, bindingDir))
+                self.mergeTasks(tasks, outputDict)
+
+    def setupBranchDirectory(self, branchDir):
+        """
+        make a self-contained sub-directory for an independent task, with its own copy of the run files
+        :param branchDir:
+        :return: absolute path to the sub-directory
+        """
+        os.makedirs(branchDir + '/outfiles', exist_ok=True)  # scratch directory of the task: may be left over by an earlier run in this workdir
+        for file in ['parameters.csv', 'commands.template.dat', 'commands.template_quick.dat', 'commands.template_long.dat',
+                     'leap_template.in', 'backbone_dihedrals.csv', 'foldedSequence_0.pdb']:
+            if os.path.exists(file):
+                copyfile(file, branchDir + '/' + file)
+        if os.path.isdir('ld_scripts') and not os.path.exists(branchDir + '/ld_scripts'):  # lightdock paths in params are relative to the working directory
+            os.symlink(os.path.abspath('ld_scripts'), branchDir + '/ld_scripts')
+
+        return os.path.abspath(branchDir)
+
+    def getTaskInputs(self):
+        """
+        what a branch or binding task needs to build its own pipeline in a worker process (see getTaskPipeline)
+        plain data only, rather than this pipeline with its scheduler and feature store
+        :return:
+        """
+        return {'params': self.params, 'actionDict': self.actionDict, 'workDir': self.workDir,
+                'pdbDict': dict(self.pdbDict), 'dcdDict': dict(self.dcdDict),
+                'state': {attribute: getattr(self, attribute) for attribute in ['ssAnalysis', 'pairLists', 'ns_per_day'] if hasattr(self, attribute)},
+                'num2dStructures': self.num2dStructures,
+                'deadline': self.scheduler.deadline, 'measurements': {stage: list(measurements) for stage, measurements in self.scheduler.measurements.items()}}
+
+    def getTaskDeltas(self, taskInputs, storeIndex):
+        """
+        what the task of this pipeline added to the scheduler and feature store, to be merged by mergeTaskOutputs
+        :param taskInputs: see getTaskInputs
+        :param storeIndex: feature store index at the start of the task
+        :return: new throughput measurements of each stage, and new or extended feature store entries
+        """
+        measurements = {stage: self.scheduler.measurements[stage][len(taskInputs['measurements'][stage]):] for stage in self.scheduler.measurements.keys()}
+        storeEntries = {}
+        if self.featureStore is not None:
+            storeEntries = {trajectory: entry for trajectory, entry in self.featureStore.readIndex().items() if storeIndex.get(trajectory) != entry}
+
+        return measurements, storeEntries
+
+    def mergeTasks(self, tasks, outputDict):
+        """
+        merge the outputs of each task once it is finished
+        if a task ran out of walltime, its error is raised after the outputs of all the other tasks are merged
+        :param tasks: futures of the branch or binding tasks
+        :param outputDict:
+        :return:
+        """
+        walltimeError = None
+        for task in tasks:
+            try:
+                self.mergeTaskOutputs(task.result(), outputDict)
+            except walltimeExceeded as error:
+                walltimeError = error
+        if walltimeError is not None:
+            raise walltimeError
+
+    def mergeTaskOutputs(self, taskOutputs, outputDict):
+        """
+        collect the results, output files, throughput measurements and feature store entries of a finished branch or binding task
+        :param taskOutputs: (outputDict, pdbDict, dcdDict, (measurements, store entries)) of the task
+        :param outputDict:
+        :return:
+        """
+        taskOutputDict, taskPdbDict, taskDcdDict, (measurements, storeEntries) = taskOutputs
+        for key in taskOutputDict.keys():
+            if key != 'params':
+                outputDict[key] = taskOutputDict[key]
+        self.pdbDict.update(taskPdbDict)
+        self.dcdDict.update(taskDcdDict)
+        self.scheduler.merge(measurements)
+        if self.featureStore is not None:
+            self.featureStore.update(storeEntries)
+        self.saveOutputs(outputDict)
+
     # ======================================================================================
     # ======================================================================================
     # ====================== supporting functions are followed (part1) =====================
@@ -331,7 +498,11 @@ class opendna:
             return pairList
 
         elif self.params['secondary structure engine'] == 'NUPACK':
-            nup = interfaces.nupack(sequence, self.params['temperature'], self.params['ionicStrength'], self.params['[Mg]'])  # initialize nupack
+            if self.params['nupack cache'] is True:  # reuse analyses of this sequence under the same conditions from previous runs
+                cache = self.getCache()
+            else:
+                cache = None
+            nup = interfaces.nupack(sequence, self.params['temperature'], self.params['ionicStrength'], self.params['[Mg]'], cache=cache)  # initialize nupack
             self.ssAnalysis = nup.run()  # run nupack analysis of possible 2D structures.
 
             distances = getSecondaryStructureDistance(self.ssAnalysis['config'])
@@ -353,6 +524,16 @@ class opendna:
         :param pairList: list of binding base pairs
         :return:
         """
+        if self.params['fold cache'] is True:  # reuse an MMB fold of the same 2D structure from a previous run
+            foldInputs = ('mmb', sequence, np.asarray(pairList).tolist(), self.params['fold speed'], self.params['foldFidelity'], self.params['temperature'], self.getMMBTemplateHashes())
+            cachedFold = self.getCache().get(foldInputs)
+            if cachedFold is not None:
+                with open('foldedSequence_{}.pdb'.format(self.i), 'w') as f:
+                    f.write(cachedFold['structure'])
+                self.pdbDict['mmb folded sequence {}'.format(self.i)] = 'foldedSequence_{}.pdb'.format(self.i)
+                printRecord('Loaded folded sequence from cache, fold fidelity = %.3f' % cachedFold['fold fidelity'])
+                return
+
         # write pair list as fictitious forces to the MMB command file
         printRecord("Folding Sequence. Fold speed={}".format(self.params['fold speed']))        
 
@@ -380,6 +561,9 @@ class opendna:
                 # TODO: what does intervalLength do in nupack???
 
         self.pdbDict['mmb folded sequence {}'.format(self.i)] = mmb.foldedSequence  # mmb.foldedSequence = foldedSequence_{}.pdb: defined in the mmb.run()
+        if self.params['fold cache'] is True:
+            with open(mmb.foldedSequence, 'r') as f:
+                self.getCache().put(foldInputs, {'structure': f.read(), 'fold fidelity': foldFidelity})
         os.system('mv commands.run* ' + mmb.fileDump)  # mmb.fileDump is a directory for intermediate files during running MMB
         printRecord("Folded Sequence")
 
@@ -400,29 +584,27 @@ class opendna:
 
             print('Done preparing files with waterbox. Start openmm.')
 
-        else:  # prepare prmtop and crd file using LEap in ambertools
-            printRecord('Implicit solvent: running LEap to generate .prmtop and .crd for folded aptamer...')
-            #os.system('pdb4amber {}.pdb > {}_amb_processed.pdb 2> {}_pdb4amber_out.log'.format(structureName, structureName, structureName))
-            copyfile(structure, structureName + '_amb_processed.pdb')
-            copyfile('./leap_template.in', 'leap.in')
-            replaceText('leap.in', 'myDNASEQ', structureName)
-            os.system('tleap -f leap.in > leap.out')
-            os.system('tail -1 leap.out')  # show last line
-            # printRecord(readFinalLines('leap.out', 1))  # show last line. problematic
-            structureName += '_amb'  # after pdb4amber and saveAmberParm, the file name became structureName_amb_processed.pdb/top/crd
+        else:  # prepare the structure, and with tleap, prmtop and crd files
+            printRecord('Implicit solvent: preparing folded aptamer...')
+            structureName = self.prepImplicitSolvent(structure)
 
         processedStructure = structureName + '_processed.pdb'
         processedStructureTrajectory = structureName + '_processed_trajectory.dcd'
         omm = interfaces.omm(structure=processedStructure, params=self.params, simTime=self.params['smoothing time'], implicitSolvent=implicitSolvent)
-        self.ns_per_day = omm.doMD()  # run MD in OpenMM framework
+        with Timer() as mdTime:
+            self.ns_per_day = omm.doMD()  # run MD in OpenMM framework
+        self.scheduler.record('md', self.params['smoothing time'], mdTime.interval, omm.topology.getNumAtoms())
 
         printRecord('Pre-relaxation simulation speed %.1f' % self.ns_per_day + 'ns/day')  # print out sampling speed
 
         if implicitSolvent is False:
-            cleanTrajectory(processedStructure, processedStructureTrajectory)  # remove water and salt from trajectory
+            if self.params['solute trajectory'] is False:  # otherwise omm already wrote the clean structure and trajectory
+                cleanTrajectory(processedStructure, processedStructureTrajectory)  # remove water and salt from trajectory
         else:  # no water or salt to remove
             copyfile(processedStructure, 'clean_' + processedStructure)  # TODO no cleaning for now
             copyfile(processedStructureTrajectory, 'clean_' + processedStructureTrajectory)  # TODO no cleaning for now
+            if self.featureStore is not None:  # same frames, same features
+                self.featureStore.rename(processedStructureTrajectory, 'clean_' + processedStructureTrajectory, keep=True)
 
         self.dcdDict['relaxed sequence {}'.format(self.i)] = 'clean_' + processedStructureTrajectory        
         self.pdbDict['relaxed sequence {}'.format(self.i)] = 'relaxedSequence_{}.pdb'.format(self.i)  # specify the file name for final frame, ie, relaxed sequence
@@ -439,6 +621,43 @@ class opendna:
 
         self.pdbDict['representative aptamer {}'.format(self.i)] = 'relaxedSequence_{}.pdb'.format(self.i)  # in "smooth dock" mode
 
+    def prepImplicitSolvent(self, structure):
+        """
+        prepare a structure for implicit solvent MD as structureName_amb_processed.pdb
+        with params['implicit solvent builder'] = 'tleap', LEap in ambertools also writes its .top and .crd files. They are cached by the hashes of the structure and the leap template
+        with 'openmm', prepPDB corrects the MMB output and adds missing atoms and hydrogens, without water, then omm parameterizes it with the amber14 force field and the GB model
+        :param structure:
+        :return: structureName_amb, the prefix of the prepared files
+        """
+        structureName = structure.split('.')[0]
+        #os.system('pdb4amber {}.pdb > {}_amb_processed.pdb 2> {}_pdb4amber_out.log'.format(structureName, structureName, structureName))
+        if self.params['implicit solvent builder'] == 'openmm':  # the force field needs every atom, hydrogens included
+            copyfile(structure, structureName + '_amb.pdb')
+            prepPDB(structureName + '_amb.pdb', self.params['box offset'], self.params['pH'], self.params['ionicStrength'], MMBCORRECTION=True, waterBox=False)
+        else:
+            copyfile(structure, structureName + '_amb_processed.pdb')
+            leapInputs = ('tleap', getFileHash(structure), getFileHash('./leap_template.in'))
+            cachedLeap = self.getCache().get(leapInputs) if self.params['system cache'] is True else None
+            if cachedLeap is not None:
+                for extension, content in cachedLeap.items():
+                    with open(structureName + '_amb_processed' + extension, 'w') as f:
+                        f.write(content)
+                printRecord('Loaded LEap .prmtop and .crd from cache')
+            else:
+                copyfile('./leap_template.in', 'leap.in')
+                replaceText('leap.in', 'myDNASEQ', structureName)
+                os.system('tleap -f leap.in > leap.out')
+                os.system('tail -1 leap.out')  # show last line
+                # printRecord(readFinalLines('leap.out', 1))  # show last line. problematic
+                if self.params['system cache'] is True:
+                    cachedLeap = {}
+                    for extension in ['.top', '.crd']:
+                        with open(structureName + '_amb_processed' + extension, 'r') as f:
+                            cachedLeap[extension] = f.read()
+                    self.getCache().put(leapInputs, cachedLeap)
+
+        return structureName + '_amb'  # after pdb4amber and saveAmberParm, the file name became structureName_amb_processed.pdb/top/crd
+
     def runFreeAptamer(self, aptamer, implicitSolvent=False):
         """
         Run MD sampling for free aptamer and relevant analysis
@@ -459,41 +678,38 @@ class opendna:
             if implicitSolvent is False:
                 # set up periodic box and condition: pH and ionic strength => protons, ions and their concentrations
                 prepPDB(aptamer, self.params['box offset'], self.params['pH'], self.params['ionicStrength'], MMBCORRECTION=True, waterBox=True)
-            else:  # prepare prmtop and crd file using LEap in ambertools
-                printRecord('Implicit solvent: running LEap to generate .prmtop and .crd for relaxed aptamer...')
-                # os.system('pdb4amber {}.pdb > {}_amb_processed.pdb 2> {}_pdb4amber_out.log'.format(structureName, structureName, structureName))
-                copyfile(aptamer, structureName + '_amb_processed.pdb')
-                copyfile('./leap_template.in', 'leap.in')
-                replaceText('leap.in', 'myDNASEQ', structureName)
-                os.system('tleap -f leap.in > leap.out')
-                os.system('tail -1 leap.out')  # show last line
-                # printRecord(readFinalLines('leap.out', 1))  # show last line. problematic            
-                structureName += '_amb'  # after pdb4amber and saveAmberParm, the file name became structureName_amb_processed.pdb/top/crd
+            else:  # prepare the structure, and with tleap, prmtop and crd files
+                printRecord('Implicit solvent: preparing relaxed aptamer...')
+                structureName = self.prepImplicitSolvent(aptamer)
 
             processedAptamer = structureName + '_processed.pdb'
             self.autoMD(structure=processedAptamer, binding=False, implicitSolvent=implicitSolvent)  # run MD sampling till converged to equilibrium sampling of RC's
             processedAptamerTrajectory = structureName + '_processed_complete_trajectory.dcd'  # this is output file of autoMD
 
         printRecord('Free aptamer simulation speed %.1f' % self.ns_per_day + ' ns/day')  # print out sampling speed
-        self.checkRuntime()
-        print("\nChecked time. Try cleaning")
 
         if implicitSolvent is False:
-            cleanTrajectory(processedAptamer, processedAptamerTrajectory)  # clean up trajectory for later use. by doing what?
+            if self.params['solute trajectory'] is False:  # otherwise omm already wrote the clean structure and trajectory
+                cleanTrajectory(processedAptamer, processedAptamerTrajectory)  # clean up trajectory for later use. by doing what?
             printRecord("Cleaned traj. Start analyzing.")    
         else:  # no water or salt to remove
             copyfile(processedAptamer, 'clean_' + processedAptamer)  # TODO no cleaning for now
             copyfile(processedAptamerTrajectory, 'clean_' + processedAptamerTrajectory)  # TODO no cleaning for now
+            if self.featureStore is not None:  # same frames, same features
+                self.featureStore.rename(processedAptamerTrajectory, 'clean_' + processedAptamerTrajectory, keep=True)
             printRecord("No cleaning in implicit solvent, just copied traj. Start analyzing.")
             
         self.dcdDict['sampled aptamer {}'.format(self.i)] = 'clean_' + processedAptamerTrajectory
         self.pdbDict['sampled aptamer {}'.format(self.i)] = 'clean_' + processedAptamer
-        aptamerDict = self.analyzeTrajectory(self.pdbDict['sampled aptamer {}'.format(self.i)], self.dcdDict['sampled aptamer {}'.format(self.i)])
+        with Timer() as analysisTime:
+            aptamerDict = self.analyzeTrajectory(self.pdbDict['sampled aptamer {}'.format(self.i)], self.dcdDict['sampled aptamer {}'.format(self.i)])
+        self.scheduler.record('analysis', len(aptamerDict['RC trajectories']), analysisTime.interval)
         # Within analyzeTrajectory, the last step is also to save an representative frame. We can also replace it using OpenMM??
             # self.omm.extractLastFrame('repStructure_%d' % self.i + '.pdb', representativeIndex) # need more scripting to complete it
         # aptamerDict = {}
         # TODO: analyzeTraj --> getNucDAtraj --> Dihedral: raise ValueError("All AtomGroups must contain 4 atoms")        
         self.pdbDict['representative aptamer {}'.format(self.i)] = 'repStructure_{}.pdb'.format(self.i)
+        aptamerDict['replica seeds'] = self.replicaSeeds  # to reproduce the sampling
 
         printRecord('Free aptamer sampling complete')
 
@@ -512,7 +728,9 @@ class opendna:
 
         buildPeptide(self.peptide, customAngles=bool(self.params['peptide backbone constraint constant']))
         ld = interfaces.ld(aptamer, peptide, self.params, self.i)  # ld is a new class, therefore need to pass in this class's params: self.params
-        ld.run()
+        with Timer() as dockingTime:
+            ld.run()
+        self.scheduler.record('docking', ld.swarms, dockingTime.interval)
         topScores = ld.topScores
 
         for i in range(self.params['N docked structures']):
@@ -537,20 +755,22 @@ class opendna:
         processedComplex = complex.split('.')[0] + '_processed.pdb'
         processedComplexTrajectory = processedComplex.split('.')[0] + '_complete_trajectory.dcd'  # this is output file of autoMD
 
-        self.autoMD(processedComplex, binding=True)
+        sampledTime = self.autoMD(processedComplex, binding=True)
 
         printRecord('Complex simulation speed %.1f' % self.ns_per_day + ' ns/day')  # print out sampling speed
-        self.checkRuntime()
 
-        cleanTrajectory(processedComplex, processedComplexTrajectory)
+        if self.params['solute trajectory'] is False:  # otherwise omm already wrote the clean structure and trajectory
+            cleanTrajectory(processedComplex, processedComplexTrajectory)
 
         self.dcdDict['sampled complex {} {}'.format(self.i, self.j)] = 'clean_' + processedComplexTrajectory
         self.pdbDict['sampled complex {} {}'.format(self.i, self.j)] = 'clean_' + processedComplex
 
-        bindingDict = self.analyzeBinding(self.pdbDict['sampled complex {} {}'.format(self.i, self.j)],
-                                          self.dcdDict['sampled complex {} {}'.format(self.i, self.j)],
-                                          self.pdbDict['sampled aptamer {}'.format(self.i)],
-                                          self.dcdDict['sampled aptamer {}'.format(self.i)])
+        with Timer() as analysisTime:
+            bindingDict = self.analyzeBinding(self.pdbDict['sampled complex {} {}'.format(self.i, self.j)],
+                                              self.dcdDict['sampled complex {} {}'.format(self.i, self.j)],
+                                              self.pdbDict['sampled aptamer {}'.format(self.i)],
+                                              self.dcdDict['sampled aptamer {}'.format(self.i)])
+        self.scheduler.record('analysis', int(sampledTime * 1000 / self.params['print step']), analysisTime.interval)  # frames written by the reporters
         # print findings
         printRecord('Binding Results: Contact Persistence = {:.2f}, Contact Score = {:.2f}, Conformation Change = {:.2f}'.format(bindingDict['close contact ratio'], bindingDict['contact score'], bindingDict['conformation change']))
         # TODO: why {:.2f} instead of {.2f}?
@@ -564,7 +784,7 @@ class opendna:
         Optionally, sample after we reach convergence ("equilibrium") -- not implemented yet (?)
         :param structure:
         :param binding:
-        :return:
+        :return: ns of sampling, summed over the replicas
         """
         if binding:  # whether it's complex or free aptamer
             maxIter = self.params['max complex sampling iterations']
@@ -573,41 +793,131 @@ class opendna:
         cutoff = self.params['autoMD convergence cutoff']
 
         structureName = structure.split('.')[0]  # e.g., structure: relaxedSequence_0_amb_processed.pdb (implicit solvent) or relaxedSequence_0_processed.pdb (explicit solvent)
-        if self.params['auto sampling'] is False:  # just run MD for the given sampling time
-            self.analyteUnbound = False
-            omm = interfaces.omm(structure=structure, params=self.params, implicitSolvent=implicitSolvent)
-            self.ns_per_day = omm.doMD()  # run MD in OpenMM framework
-            print('Generated:', structureName + '_trajectory.dcd')
-            os.replace(structureName + '_trajectory.dcd', structureName + "_complete_trajectory.dcd")
-            print('Replaced ^ with:', structureName + '_complete_trajectory.dcd')
-
-        elif self.params['auto sampling'] is True:  # run MD till convergence (equilibrium)
-            converged = False
-            iter = 0
-            self.analyteUnbound = False
-
-            while (converged is False) and (iter < maxIter):
-                iter += 1
-                omm = interfaces.omm(structure=structure, params=self.params, implicitSolvent=implicitSolvent)
-                self.ns_per_day = omm.doMD()
-
-                if iter > 1:  # if we have multiple trajectory segments, combine them
-                    appendTrajectory(structure, structureName + '_trajectory-1.dcd', structureName + '_trajectory.dcd')
-                    os.replace('combinedTraj.dcd', structureName + '_trajectory-1.dcd')
-                else:
-                    os.replace(structureName + '_trajectory.dcd', structureName + '_trajectory-1.dcd')  # in case we need to combine two trajectories
-
-                combinedSlope = checkTrajPCASlope(structure, structureName + '_trajectory-1.dcd', self.params['print step'])
-                # TODO what is the slope and what it for?
-                if binding:
-                    self.analyteUnbound = checkMidTrajectoryBinding(structure, structureName + '_trajectory-1.dcd', self.peptide, self.sequence, self.params, cutoffTime=1)
-                    if self.analyteUnbound:
-                        printRecord('Analyte came unbound!')
-
-                if (combinedSlope < cutoff) or (self.analyteUnbound is True):
-                    converged = True
-
-            os.replace(structureName + '_trajectory-1.dcd', structureName + '_complete_trajectory.dcd')
+        if (self.params['solute trajectory'] is True) and (implicitSolvent is False):  # analyze the solute-only trajectory written by omm
+            analysisPrefix = 'clean_'
+        else:
+            analysisPrefix = ''
+        if binding or (self.params['pick up from chk'] is True):  # replicas are for the free aptamer, and a checkpoint resumes a single simulation
+            replicas = 1
+        else:
+            replicas = self.params['replicas']
+        replicaDirs = [self.getReplicaDirectory(structure, replica, replicas) for replica in range(replicas)]
+        systemSize = mda.Universe(structure).atoms.n_atoms
+        stageParams = dict(self.params)  # the scheduled sampling time only applies to this run
+        stageParams['sampling time'] = self.getSamplingTime(systemSize, binding)
+        segments = 0
+
+        with mdSession(structure, stageParams, implicitSolvent, replicaDirs) as session:  # the simulations are set up once, and continued segment after segment
+            self.replicaSeeds = [int(seed) for seed in session.seeds]
+            if self.params['auto sampling'] is False:  # just run MD for the given sampling time
+                self.analyteUnbound = False
+                self.ns_per_day = self.runScheduledSegment(session, stageParams['sampling time'], systemSize)  # run MD in OpenMM framework
+                segments = 1
+
+            elif self.params['auto sampling'] is True:  # run MD till convergence (equilibrium)
+                converged = False
+                iter = 0
+                self.analyteUnbound = False
+                convergenceMonitor = trajectoryConvergenceMonitor(analysisPrefix + structure, self.params['print step'], replicas, store=self.featureStore)  # only analyzes the frames of each new segment
+                lastContact = None  # frame of the last analyte-aptamer contact, in binding runs
+
+                while (converged is False) and (iter < maxIter):
+                    if (iter > 0) and not self.scheduler.fits('md', stageParams['sampling time'], systemSize):  # stop with complete segments, rather than be killed mid-segment
+                        printRecord('Stopping sampling after {} segments: the next one would not finish within the walltime'.format(iter))
+                        break
+                    iter += 1
+                    self.ns_per_day = self.runScheduledSegment(session, stageParams['sampling time'], systemSize)  # later segments are appended to the first one's trajectory
+                    segments += 1
+                    segmentStart = int(convergenceMonitor.nFrames[0])  # first frame of the new segment
+                    combinedSlope = convergenceMonitor.update(*[replicaDir + analysisPrefix + structureName + '_trajectory.dcd' for replicaDir in replicaDirs])  # only reads the new segment's frames
+                    # TODO what is the slope and what it for?
+
+                    if binding:
+                        self.analyteUnbound, lastContact = checkMidTrajectoryBinding(analysisPrefix + structure, analysisPrefix + structureName + '_trajectory.dcd', self.peptide, self.sequence, self.params, cutoffTime=1,
+                                                                                     start=segmentStart, lastContact=lastContact, store=self.featureStore)  # only the new segment's frames
+                        if self.analyteUnbound:
+                            printRecord('Analyte came unbound!')
+
+                    if (combinedSlope < cutoff) or (self.analyteUnbound is True):
+                        converged = True
+
+        for prefix in ['', 'clean_']:  # full and/or solute-only trajectory
+            if (replicas > 1) and os.path.exists(replicaDirs[0] + prefix + structureName + '_trajectory.dcd'):  # one trajectory of all the replicas, one after another, for the analysis
+                combineTrajectories(prefix + structure, [replicaDir + prefix + structureName + '_trajectory.dcd' for replicaDir in replicaDirs], prefix + structureName + '_trajectory.dcd')
+            if os.path.exists(prefix + structureName + '_trajectory.dcd'):
+                os.replace(prefix + structureName + '_trajectory.dcd', prefix + structureName + '_complete_trajectory.dcd')
+                if self.featureStore is not None:
+                    self.featureStore.rename(prefix + structureName + '_trajectory.dcd', prefix + structureName + '_complete_trajectory.dcd')
+                print('Generated:', prefix + structureName + '_complete_trajectory.dcd')
+
+        return segments * stageParams['sampling time']  # the replicas share the sampling time
+
+    def runScheduledSegment(self, session, samplingTime, systemSize):
+        """
+        run the next MD segment of a session, and record its throughput with the scheduler
+        :param session: mdSession
+        :param samplingTime: ns
+        :param systemSize: number of atoms
+        :return: sampling speed in ns/day
+        """
+        with Timer() as segmentTime:
+            ns_per_day = session.runSegment()
+        self.scheduler.record('md', samplingTime, segmentTime.interval, systemSize)
+
+        return ns_per_day
+
+    def getSamplingTime(self, systemSize, binding):
+        """
+        length of the sampling segments of the current MD run, so that it and the remaining MD runs of the pipeline fit in the walltime
+        the remaining runs are the free aptamer samplings, dockings and binding runs still to do for this and the following 2D structures, shared between the branch workers
+        raises walltimeExceeded if even 100 ps segments no longer fit
+        :param systemSize: number of atoms
+        :param binding: whether the current run is a binding run
+        :return: sampling time in ns, at most params['sampling time']
+        """
+        futureBranches = self.num2dStructures - self.i - 1
+        freeRuns, dockingRuns, bindingRuns = 0, 0, 0
+        if self.actionDict['get equil repStructure']:
+            freeRuns = futureBranches + (binding is False)
+        if self.actionDict['do docking'] and (self.peptide is not False):
+            dockingRuns = futureBranches + (binding is False)
+        if self.actionDict['do binding']:
+            bindingRuns = (futureBranches + (binding is False)) * self.params['N docked structures'] + binding * (self.params['N docked structures'] - self.j)
+        if self.params['auto sampling'] is True:
+            segments = freeRuns * self.params['max aptamer sampling iterations'] + bindingRuns * self.params['max complex sampling iterations']
+        else:
+            segments = freeRuns + bindingRuns
+        if self.params['parallel branches'] is True:  # the branches run side by side
+            workers = self.params['branch workers']
+            segments, dockingRuns = int(np.ceil(segments / workers)), int(np.ceil(dockingRuns / workers))
+
+        framesPerNs = 1000 / self.params['print step']
+        samplingTime = self.scheduler.allocateSamplingTime(self.params['sampling time'], max(segments, 1), systemSize, framesPerNs, dockingRuns)
+        if samplingTime < 0.1:
+            raise walltimeExceeded('Sampling time would be reduced below 100 ps - this run is too expensive, and will now terminate. Completed stages can be resumed with params[\'resume stages\']')
+        elif samplingTime < self.params['sampling time']:
+            printRecord('Sampling time chunk reduced to {:.3g} ns to fit {} segments in the remaining {:.1f} h of walltime'.format(samplingTime, segments, self.scheduler.getRemainingTime() / 3600))
+
+        return samplingTime
+
+    def getReplicaDirectory(self, structure, replica, replicas):
+        """
+        sub-directory with its own copy of the structure files for a replica, or the working directory itself for a single simulation
+        :param structure:
+        :param replica:
+        :param replicas:
+        :return: path to prefix output file names with
+        """
+        if replicas == 1:
+            return ''
+
+        replicaDir = structure.split('.')[0] + '_replica_{}'.format(replica)
+        os.makedirs(replicaDir, exist_ok=True)
+        for file in [structure, structure.split('.')[0] + '.top', structure.split('.')[0] + '.crd', 'backbone_dihedrals.csv']:  # .top and .crd in implicit solvent
+            if os.path.exists(file):
+                copyfile(file, replicaDir + '/' + file)
+
+        return os.path.abspath(replicaDir) + '/'
 
     def analyzeTrajectory(self, structure, trajectory):
         """
@@ -615,12 +925,11 @@ class opendna:
         :param trajectory:
         :return:
         """
-        u = mda.Universe(structure, trajectory)
-
         # extract distance info through the trajectory
-        wcTraj = getWCDistTraj(u)  # watson-crick base pairing distances (H-bonding)
-        baseDistTraj = getBaseBaseDistTraj(u)  # FAST, base-base center-of-geometry distances
-        nucleicAnglesTraj = getNucDATraj(u)  # FAST, new, omits 'chi' angle between ribose and base
+        features = getTrajectoryFeatures(structure, trajectory, ['wc distances', 'base distances', 'dihedrals'], store=self.featureStore)  # single pass over the trajectory, unless already stored
+        wcTraj = features['wc distances']  # watson-crick base pairing distances (H-bonding)
+        baseDistTraj = features['base distances']  # base-base center-of-geometry distances
+        nucleicAnglesTraj = features['dihedrals']  # omits 'chi' angle between ribose and base
 
         # 2D structure analysis
         pairTraj = getPairTraj(wcTraj)
@@ -631,7 +940,7 @@ class opendna:
 
         # 3D structure analysis
         mixedTrajectory = np.concatenate((baseDistTraj.reshape(len(baseDistTraj), int(baseDistTraj.shape[-2] * baseDistTraj.shape[-1])), nucleicAnglesTraj.reshape(len(nucleicAnglesTraj), int(nucleicAnglesTraj.shape[-2] * nucleicAnglesTraj.shape[-1]))), axis=1)  # mix up all our info
-        representativeIndex, pcTrajectory, eigenvalues = isolateRepresentativeStructure(mixedTrajectory)
+        representativeIndex, pcTrajectory, eigenvalues = isolateRepresentativeStructure(mixedTrajectory, self.params['representative structure mode'])
 
         # save this structure a separate file
         extractFrame(structure, trajectory, representativeIndex, 'repStructure_%d' % self.i + '.pdb')
@@ -655,7 +964,9 @@ class opendna:
         """
         bindu = mda.Universe(bindStructure, bindTrajectory)
         freeu = mda.Universe(freeStrcuture, freeTrajectory)
-        bindingDict = bindingAnalysis(bindu, freeu, self.peptide, self.sequence)  # look for contacts between analyte and aptamer
+        bindFeatures = getTrajectoryFeatures(bindStructure, bindTrajectory, ['peptide distances', 'dihedrals'], self.peptide, self.sequence, store=self.featureStore)
+        freeAngles = getTrajectoryFeatures(freeStrcuture, freeTrajectory, ['dihedrals'], store=self.featureStore)['dihedrals']
+        bindingDict = bindingAnalysis(bindu, freeu, self.peptide, self.sequence, bindFeatures, freeAngles)  # look for contacts between analyte and aptamer
         if self.analyteUnbound:
             bindingDict['analyte came unbound'] = True
         else:
@@ -667,38 +978,396 @@ class opendna:
     # ====== supporting functions are followed (part2) ======
     # =======================================================
 
-    def checkRuntime(self):
+    def getCache(self):
+        return resultCache(self.params['cache dir'], self.params['cache size'])
+
+    def getMMBTemplateHashes(self):
         """
-        Estimate the maximum runtime for this code, given a ns/day calculation from existing work done
+        hashes of the MMB parameters and command templates in the current directory, which an MMB fold depends on
         :return:
         """
-        projectedMaxRuntime = self.computeRuntime()
-        buffer = 0.9  # ideally would like a buffer of 20% of the walltime
-        doReduction = 0
-        # if the code is going to take too long, shorten the sampling time until it fits
-        while projectedMaxRuntime > (buffer * self.params['max walltime']):  # max walltime is in hours
-            doReduction = 1
-            self.params['sampling time'] *= 0.95
-            projectedMaxRuntime = self.computeRuntime()
-
-        if doReduction == 1:
-            if self.params['sampling time'] < 0.1:
-                printRecord('Sampling time reduced to 100 ps - this run is too expensive, and will now terminate')
-                self.terminateRun()
-            else:
-                printRecord('Binding sampling time chunk reduced to {} ns'.format(self.params['sampling time']))
+        return tuple([getFileHash(file) for file in ['parameters.csv', 'commands.template.dat', 'commands.template_quick.dat', 'commands.template_long.dat']])
 
-    def computeRuntime(self):
-        dt = self.params['sampling time']  # ns in MD sampling after getting (smoothed) 3D structure
-        ssStructures = self.params['N 2D structures']
-        dockingStructures = self.params['N docked structures']
-        aptamerSteps = self.params['max aptamer sampling iterations']
-        complexSteps = self.params['max complex sampling iterations']
-        maxNS = dt * (ssStructures * aptamerSteps + ssStructures * dockingStructures * complexSteps)  # maximum possible sampling time in nanoseconds
-        projectedMaxRuntime = maxNS / self.ns_per_day * 24  # how many hours needed to complete our maximum sampling time
+    def getFreeAptamerCacheInputs(self):
+        """
+        everything the free aptamer sampling of the 2D structure #self.i depends on
+        :return:
+        """
+        if self.actionDict['do MMB']:
+            fold = ('mmb', np.asarray(self.pairList).tolist(), self.params['fold speed'], self.params['foldFidelity'], self.getMMBTemplateHashes())
+        else:  # started from a given folded structure
+            fold = ('folded structure', getFileHash(self.params['folded initial structure']))
 
-        return projectedMaxRuntime
+        return ('free aptamer', self.sequence, fold, self.getMDParams())
+
+    def getMDParams(self):
+        """
+        the params which the MD stages (smoothing, free aptamer and binding) depend on
+        :return:
+        """
+        mdParams = tuple([self.params[key] for key in ['temperature', 'pH', 'ionicStrength', 'implicit solvent', 'water model', 'box offset', 'nonbonded method', 'nonbonded cutoff',
+                                                        'constraints', 'hydrogen mass', 'integrator', 'time step', 'print step', 'friction', 'equilibration time', 'smoothing time', 'sampling time',
+                                                        'auto sampling', 'max aptamer sampling iterations', 'autoMD convergence cutoff', 'replicas', 'random seed']])
+        if self.params['implicit solvent'] is True:
+            mdParams += tuple([self.params[key] for key in ['implicit solvent builder', 'implicit solvent model', 'implicit solvent salt conc', 'implicit solvent Kappa', 'soluteDielectric', 'solventDielectric']])
+
+        return mdParams
+
+    def runStage(self, stage, inputs, function, *args, **kwargs):
+        """
+        run a stage of the pipeline, and record it in the stage manifest of the current directory
+        with params['resume stages'], a stage which was completed with the same inputs, and whose files are unchanged, is skipped and its outputs restored
+        :param stage: name of the stage, eg 'fold 0'
+        :param inputs: tuple of everything the stage depends on, including hashes of its input files
+        :param function: the stage, called with *args and **kwargs
+        :return: the return value of the stage
+        """
+        if self.workDir == "":  # no run directory (eg, '2d structure' mode): nothing to resume, and nothing to write into the code directory
+            return function(*args, **kwargs)
+
+        manifest = stageManifest()
+        if self.params['resume stages'] is True:
+            outputs = manifest.get(stage, inputs)
+            if outputs is not None:
+                self.pdbDict.update(outputs['pdbDict'])
+                self.dcdDict.update(outputs['dcdDict'])
+                self.params.update(outputs['params'])  # eg, fold speed raised by refolding
+                for attribute, value in outputs['state'].items():
+                    setattr(self, attribute, value)
+                printRecord('Resuming: stage {} was already completed with the same inputs'.format(stage))
+                return outputs['result']
+
+        pdbDict, dcdDict, params = dict(self.pdbDict), dict(self.dcdDict), dict(self.params)
+        state = copy.deepcopy({attribute: getattr(self, attribute, None) for attribute in ['ssAnalysis', 'pairLists', 'ns_per_day', 'analyteUnbound']})  # a stage may modify them in place
+        fileStamps = {file: (os.path.getsize(file), os.path.getmtime(file)) for file in list(pdbDict.values()) + list(dcdDict.values()) if os.path.exists(file)}
+        result = function(*args, **kwargs)
+
+        outputs = {'result': result,
+                   'pdbDict': {key: file for key, file in self.pdbDict.items() if pdbDict.get(key) != file},
+                   'dcdDict': {key: file for key, file in self.dcdDict.items() if dcdDict.get(key) != file},
+                   'params': {key: value for key, value in self.params.items() if (key not in params) or isChanged(params[key], value)},
+                   'state': {attribute: getattr(self, attribute) for attribute in state.keys() if isChanged(state[attribute], getattr(self, attribute, None))}}
+        rewrittenFiles = [file for file, stamp in fileStamps.items() if os.path.exists(file) and ((os.path.getsize(file), os.path.getmtime(file)) != stamp)]  # eg, the MMB correction of prepPDB
+        manifest.put(stage, inputs, outputs, list(outputs['pdbDict'].values()) + list(outputs['dcdDict'].values()) + rewrittenFiles)
+
+        return result
+
+    def loadCachedFreeAptamer(self, outputDict):
+        """
+        restore the files and results of a free aptamer sampled by a previous run under identical conditions, if its files are unchanged
+        :param outputDict:
+        :return: True if the free aptamer was found in the cache
+        """
+        self.freeAptamerCacheInputs = None
+        if (self.params['free aptamer cache'] is False) or (self.actionDict['get equil repStructure'] is False) or (self.params['pick up from chk'] is True):
+            return False
+
+        self.freeAptamerCacheInputs = self.getFreeAptamerCacheInputs()  # before any stage gets to modify params
+        cachedAptamer = self.getCache().get(self.freeAptamerCacheInputs)
+        if cachedAptamer is None:
+            return False
+
+        for file, (path, fileHash) in cachedAptamer['files'].items():
+            if (not os.path.exists(path)) or (getFileHash(path) != fileHash):  # the run which sampled it was moved, deleted or overwritten
+                printRecord('Cached free aptamer file {} is missing or changed: sampling again'.format(path))
+                return False
+        for file, (path, fileHash) in cachedAptamer['files'].items():
+            if os.path.abspath(file) != path:
+                copyfile(path, file)
+        self.pdbDict.update(cachedAptamer['pdbDict'])
+        self.dcdDict.update(cachedAptamer['dcdDict'])
+        self.ns_per_day = cachedAptamer['ns per day']
+        outputDict['free aptamer results {}'.format(self.i)] = cachedAptamer['results']
+        self.saveOutputs(outputDict)
+        printRecord('Loaded sampled free aptamer for 2D structure #{} from cache'.format(self.i))
+
+        return True
+
+    def cacheFreeAptamer(self, outputDict):
+        """
+        store the file paths and hashes and the results of a freshly sampled free aptamer for the 2D structure #self.i
+        :param outputDict:
+        :return:
+        """
+        if self.freeAptamerCacheInputs is None:
+            return
+
+        keys = [key.format(self.i) for key in ['mmb folded sequence {}', 'relaxed sequence {}', 'sampled aptamer {}', 'representative aptamer {}']]
+        pdbDict = {key: self.pdbDict[key] for key in keys if key in self.pdbDict}
+        dcdDict = {key: self.dcdDict[key] for key in keys if key in self.dcdDict}
+        files = {file: (os.path.abspath(file), getFileHash(file)) for file in list(pdbDict.values()) + list(dcdDict.values())}  # the files stay in this run's directory
+
+        cachedAptamer = {'files': files, 'pdbDict': pdbDict, 'dcdDict': dcdDict, 'ns per day': self.ns_per_day,
+                         'results': outputDict['free aptamer results {}'.format(self.i)]}
+        self.getCache().put(self.freeAptamerCacheInputs, cachedAptamer)
+
+    def saveOutputs(self, outputDict):
+        """
+        save the outputs of the pipeline so far, unless they are collected elsewhere (eg, by screen.py)
+        :param outputDict:
+        :return:
+        """
+        if self.params['save outputs'] is True:
+            np.save('opendnaOutput', outputDict)  # Save an array to a binary file in NumPy ``.npy`` format.
 
     def terminateRun(self):
         """ for some reason, the run needs to end """
         sys.exit()
+
+
+class walltimeExceeded(Exception):
+    """
+    the remaining MD runs no longer fit in the walltime: raised by getSamplingTime, also in the worker of a parallel branch,
+    and caught in opendna.run, which saves the outputs so far and ends the run
+    """
+    pass
+
+
+class walltimeScheduler:
+    """
+    budget of the walltime of a run, from the measured throughput of its stages:
+    MD in seconds per ns for a system size (cost is assumed to scale with the number of atoms), docking in seconds per swarm and trajectory analysis in seconds per frame
+    the remaining walltime is allocated to the remaining MD runs as the length of their sampling segments, leaving a margin to save outputs before the job is killed
+    """
+    def __init__(self, maxWalltime, buffer=0.9):
+        """
+        :param maxWalltime: hours, from the start of the run
+        :param buffer: fraction of the walltime to plan for
+        """
+        self.deadline = time.time() + buffer * maxWalltime * 3600
+        self.measurements = {'md': [], 'docking': [], 'analysis': []}  # (amount, seconds, system size) of each run of a stage
+
+    def record(self, stage, amount, seconds, size=None):
+        """
+        :param stage: 'md', 'docking' or 'analysis'
+        :param amount: ns of MD, docking swarms or analyzed frames
+        :param seconds: time it took
+        :param size: number of atoms, for MD
+        :return:
+        """
+        self.measurements[stage].append((amount, seconds, size))
+
+    def merge(self, measurements):
+        """
+        add the measurements of another scheduler, eg, of the task of a parallel branch
+        :param measurements: dict of lists of (amount, seconds, system size) for each stage
+        :return:
+        """
+        for stage, stageMeasurements in measurements.items():
+            self.measurements[stage].extend(stageMeasurements)
+
+    def getRemainingTime(self):
+        """ seconds until the deadline """
+        return self.deadline - time.time()
+
+    def getRate(self, stage, size=None):
+        """
+        seconds per unit of a stage (ns of MD of a system of the given size, docking swarm, analyzed frame)
+        :param stage:
+        :param size: number of atoms, for MD
+        :return: None if the stage was never measured
+        """
+        measurements = [measurement for measurement in self.measurements[stage] if measurement[0] > 0]
+        if len(measurements) == 0:
+            return None
+        if (stage == 'md') and (size is not None):
+            return np.median([seconds / amount * size / measuredSize for amount, seconds, measuredSize in measurements])
+
+        return np.sum([seconds for amount, seconds, measuredSize in measurements]) / np.sum([amount for amount, seconds, measuredSize in measurements])
+
+    def getMeanTime(self, stage):
+        """ mean seconds per run of a stage, 0 if it was never measured """
+        if len(self.measurements[stage]) == 0:
+            return 0
+
+        return np.mean([seconds for amount, seconds, size in self.measurements[stage]])
+
+    def fits(self, stage, amount, size=None):
+        """
+        whether the given amount of a stage is projected to finish before the deadline
+        :param stage:
+        :param amount:
+        :param size:
+        :return: True if the stage was never measured
+        """
+        rate = self.getRate(stage, size)
+        return (rate is None) or (amount * rate < self.getRemainingTime())
+
+    def allocateSamplingTime(self, maxSamplingTime, segments, size, framesPerNs, dockingRuns=0):
+        """
+        longest sampling segment for which the remaining segments, their analysis and the remaining dockings fit before the deadline
+        :param maxSamplingTime: ns, the requested segment length
+        :param segments: number of MD segments still to run, including those of the current run
+        :param size: number of atoms
+        :param framesPerNs: frames written, and analyzed, per ns
+        :param dockingRuns: number of docking runs still to do
+        :return: sampling time in ns, up to maxSamplingTime. maxSamplingTime if no MD was measured yet
+        """
+        mdRate = self.getRate('md', size)
+        if mdRate is None:
+            return maxSamplingTime
+        analysisRate = self.getRate('analysis') or 0
+        budget = self.getRemainingTime() - dockingRuns * self.getMeanTime('docking')
+
+        return min(maxSamplingTime, budget / (segments * (mdRate + framesPerNs * analysisRate)))
+
+
+class mdSession:
+    """
+    the OpenMM simulations of the MD segments of an autoMD run: a single simulation, or independently seeded replicas
+    each simulation builds its System and Context once, then every segment continues the dynamics of the last one, without new setup, minimization or equilibration
+    the replicas share the sampling time, and each runs on params['replica threads'] CPU threads in its own sub-directory and its own worker process, which keeps its simulation between segments
+    """
+    def __init__(self, structure, params, implicitSolvent, replicaDirs):
+        """
+        :param structure:
+        :param params:
+        :param implicitSolvent:
+        :param replicaDirs: from getReplicaDirectory
+        """
+        self.structure = structure
+        self.params = params
+        self.implicitSolvent = implicitSolvent
+        self.replicaDirs = replicaDirs
+        self.omm = None
+        self.pools = []
+        self.seeds = []
+        if len(replicaDirs) > 1:
+            self.replicaParams = params.copy()
+            self.replicaParams['sampling time'] = params['sampling time'] / len(replicaDirs)
+            self.seeds = np.random.default_rng(params['random seed']).integers(1, 2 ** 31 - 1, size=len(replicaDirs))  # reproducible with the same params['random seed']
+            printRecord('Running {} replicas of {:.3g} ns segments, with seeds {}'.format(len(replicaDirs), self.replicaParams['sampling time'], self.seeds))
+            self.pools = [ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) for replicaDir in replicaDirs]  # not forked, since this process may hold a CUDA context
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def runSegment(self):
+        """
+        run the next segment of MD sampling, appended to the trajectories of the previous ones
+        :return: sampling speed in ns/day, summed over replicas
+        """
+        if len(self.replicaDirs) == 1:
+            if self.omm is None:
+                self.omm = interfaces.omm(structure=self.structure, params=self.params, implicitSolvent=self.implicitSolvent)
+            return self.omm.doMD()
+
+        tasks = [pool.submit(runReplicaTask, self.structure, self.replicaParams, self.implicitSolvent, int(seed), replicaDir) for pool, seed, replicaDir in zip(self.pools, self.seeds, self.replicaDirs)]
+        ns_per_day = np.sum([task.result() for task in tasks])
+
+        if os.path.exists(self.replicaDirs[0] + 'clean_' + self.structure):  # the solute topology is the same for all replicas
+            copyfile(self.replicaDirs[0] + 'clean_' + self.structure, 'clean_' + self.structure)
+
+        return ns_per_day
+
+    def close(self):
+        """ release the simulations and their worker processes """
+        for pool in self.pools:
+            pool.shutdown()
+        self.pools = []
+        self.omm = None
+
+
+def getTaskPipeline(taskInputs, taskDir):
+    """
+    fresh pipeline for a branch or binding task, in the working directory of the run, working in the task's sub-directory
+    :param taskInputs: see opendna.getTaskInputs
+    :param taskDir: absolute path of the task's sub-directory
+    :return: the pipeline, and its feature store index at the start of the task
+    """
+    os.chdir(taskDir)
+    pipeline = opendna(taskInputs['params'], workDir=taskInputs['workDir'])
+    pipeline.actionDict = dict(taskInputs['actionDict'])  # as modified by setup
+    pipeline.pdbDict, pipeline.dcdDict = dict(taskInputs['pdbDict']), dict(taskInputs['dcdDict'])
+    for attribute, value in taskInputs['state'].items():
+        setattr(pipeline, attribute, value)
+    pipeline.num2dStructures = taskInputs['num2dStructures']
+    pipeline.scheduler.deadline = taskInputs['deadline']
+    pipeline.scheduler.merge(taskInputs['measurements'])
+    storeIndex = pipeline.featureStore.readIndex() if pipeline.featureStore is not None else {}
+
+    return pipeline, storeIndex
+
+
+def runBranchTask(taskInputs, i, branchDir):
+    """
+    process pool task: run the 2D structure branch #i in its own sub-directory
+    :param taskInputs: see opendna.getTaskInputs
+    :param i: index of the 2D structure
+    :param branchDir: absolute path of the task's sub-directory
+    :return: the task outputs, the absolute paths of the files it produced, and its scheduler and feature store deltas
+    """
+    pipeline, storeIndex = getTaskPipeline(taskInputs, branchDir)
+    pipeline.i = i
+    outputDict = {'params': pipeline.params}
+    pipeline.runBranch(outputDict)
+
+    return outputDict, getNewFiles(taskInputs['pdbDict'], pipeline.pdbDict), getNewFiles(taskInputs['dcdDict'], pipeline.dcdDict), pipeline.getTaskDeltas(taskInputs, storeIndex)
+
+
+def runBindingTask(taskInputs, i, j, bindingDir):
+    """
+    process pool task: run the binding dynamics of docked structure #j of the 2D structure #i in its own sub-directory
+    :param taskInputs: see opendna.getTaskInputs, with the merged outputs of the branch tasks
+    :param i: index of the 2D structure
+    :param j: index of the docked structure
+    :param bindingDir: absolute path of the task's sub-directory
+    :return: the task outputs, the absolute paths of the files it produced, and its scheduler and feature store deltas
+    """
+    pipeline, storeIndex = getTaskPipeline(taskInputs, bindingDir)
+    pipeline.i, pipeline.j = i, j
+    complexKey = 'binding complex {} {}'.format(i, j)
+    copyfile(pipeline.pdbDict[complexKey], os.path.basename(pipeline.pdbDict[complexKey]))
+    pipeline.pdbDict[complexKey] = os.path.basename(pipeline.pdbDict[complexKey])
+    pdbDict = dict(pipeline.pdbDict)
+    outputDict = {'params': pipeline.params}
+    pipeline.runBinding(outputDict)
+
+    return outputDict, getNewFiles(pdbDict, pipeline.pdbDict), getNewFiles(taskInputs['dcdDict'], pipeline.dcdDict), pipeline.getTaskDeltas(taskInputs, storeIndex)
+
+
+replicaSimulations = {}  # in the worker process of a replica: its simulation, continued by each of its segments
+
+
+def runReplicaTask(structure, params, implicitSolvent, seed, replicaDir):
+    """
+    process pool task: run the next MD segment of one replica in its own sub-directory
+    the first segment sets up the simulation, which the worker process keeps for the next ones
+    :param structure:
+    :param params: with the replica's share of the sampling time
+    :param implicitSolvent:
+    :param seed: random seed of the replica
+    :param replicaDir: absolute path of the replica's sub-directory
+    :return: sampling speed in ns/day
+    """
+    os.chdir(replicaDir)
+    if replicaDir not in replicaSimulations:
+        replicaSimulations[replicaDir] = interfaces.omm(structure=structure, params=params, implicitSolvent=implicitSolvent, seed=seed, threads=params['replica threads'])
+
+    return replicaSimulations[replicaDir].doMD()
+
+
+def isChanged(old, new):
+    """
+    compare a value with an earlier copy of it, by value, also for numpy arrays and containers of them
+    :param old:
+    :param new:
+    :return:
+    """
+    try:
+        return bool(old != new)
+    except ValueError:  # the truth value of an array comparison is ambiguous
+        return pickle.dumps(old) != pickle.dumps(new)
+
+
+def getNewFiles(oldDict, newDict):
+    """
+    entries of a pdbDict or dcdDict which were added or changed by a task, as absolute paths
+    :param oldDict:
+    :param newDict:
+    :return:
+    """
+    return {key: os.path.abspath(file) for key, file in newDict.items() if oldDict.get(key) != file}
@@ -1,4 +1,5 @@
 from utils import *
+from analysisTools import featureStore
 
 # we want to collate the relevant trajectories and all the relevant analyses
 
@@ -13,6 +14,11 @@ os.chdir(dir)
 
 outputs = np.load('opendnaOutput.npy',allow_pickle=True).item() # load outputs
 
+# per-frame features (reaction coordinates) of the analyzed trajectories, as stored during the run
+if os.path.exists('featureStore'):
+    trajectoryFeatures = featureStore('featureStore').getAllFeatures()
+    np.savez('trajectoryFeatures', **{os.path.basename(trajectory) + '/' + feature: values for trajectory, features in trajectoryFeatures.items() for feature, values in features.items()})  # written from the memory-mapped store in chunks, 'trajectory/feature' keys
+
 runPairs = []
 
 # recenter trajectory files
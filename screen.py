@@ -0,0 +1,220 @@
+"""
+Screening driver: run the opendna pipeline over a library of aptamer sequences x target peptides
+
+python screen.py --library aptamers.fasta --peptides YQTQTNSPRRAR,YRRYRRYRRY --workers 4
+python screen.py --library pairs.csv --array_index $SLURM_ARRAY_TASK_ID --array_size 100
+
+All other settings (mode, physical params, walltime etc.) are taken from main.py and its command line arguments.
+Stages which only depend on the aptamer (2D analysis, MMB fold, free aptamer sampling) are run once per sequence,
+then reused for every peptide through the result cache in params['cache dir'].
+Results of all pairs are collected in a single table, screeningResults.csv, in the screen directory.
+"""
+import csv
+import copy
+import time
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_screen_input():
+    """
+    get the command line input for the screen
+    :return: the screen arguments, and the remaining arguments, which belong to main.py
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--library', type=str, required=True)  # FASTA of aptamer sequences, or CSV with a 'sequence' and optionally a 'peptide' column
+    parser.add_argument('--peptides', type=str, default=None)  # FASTA or comma-separated list of peptides, screened against every sequence in the library
+    parser.add_argument('--workers', type=int, default=1)  # number of pipelines running in parallel
+    parser.add_argument('--array_index', type=int, default=0)  # index of this job in a job array
+    parser.add_argument('--array_size', type=int, default=1)  # the library is split into array_size contiguous chunks
+    parser.add_argument('--screen_dir', type=str, default=None)  # default: params['workdir'] + '/screen'
+
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    screenInput, mainArgs = get_screen_input()
+    sys.argv = sys.argv[:1] + mainArgs  # main.py parses the rest of the command line when it is imported
+
+from main import params
+from opendna import *
+
+# modes with docking first run the cheapest aptamer-only mode which fills the caches they need, once per sequence
+aptamerModes = {'coarse dock': '3d coarse',
+                'smooth dock': '3d coarse',  # smoothing is not cached
+                'full docking': 'free aptamer',
+                'full binding': 'free aptamer'}
+
+resultColumns = ['sequence', 'peptide', 'mode', 'status', 'runtime (h)', '2d structure', 'dock scores',
+                 'close contact ratio', 'contact score', 'conformation change', 'workdir']
+
+
+def readSequences(file):
+    """
+    read sequences from a FASTA file (sequences may span several lines) or a plain file with one sequence per line
+    :param file:
+    :return:
+    """
+    sequences = []
+    newRecord = True
+    with open(file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('>'):
+                newRecord = True
+            elif len(line) > 0:
+                if newRecord or not file.endswith(('.fasta', '.fa')):
+                    sequences.append(line)
+                else:
+                    sequences[-1] += line
+                newRecord = False
+
+    return sequences
+
+
+def readLibrary(library, peptides=None):
+    """
+    list the (sequence, peptide) pairs to screen
+    :param library: FASTA file of sequences, or CSV file with a 'sequence' (and 'peptide') column
+    :param peptides: FASTA file or comma-separated list of peptides, combined with every sequence of the library
+    :return:
+    """
+    if library.endswith('.csv'):
+        with open(library, 'r') as f:
+            rows = list(csv.DictReader(f))
+        sequences = [row['sequence'].strip() for row in rows]
+        libraryPeptides = [row['peptide'].strip() if row.get('peptide') else 'A' for row in rows]  # 'A' <==> free aptamer
+    else:
+        sequences = readSequences(library)
+        libraryPeptides = ['A'] * len(sequences)
+
+    if peptides is None:
+        return list(zip(sequences, libraryPeptides))
+    elif os.path.exists(peptides):
+        peptides = readSequences(peptides)
+    else:
+        peptides = [peptide.strip() for peptide in peptides.split(',')]
+
+    return [(sequence, peptide) for sequence in sequences for peptide in peptides]
+
+
+def runPipelineTask(codeDir, screenParams, sequence, peptide, mode, workdir, runNum):
+    """
+    process pool task: run one pipeline in its own run directory
+    :return: a row of the results table
+    """
+    os.chdir(codeDir)  # the pipeline copies its input files from relative paths
+    taskParams = copy.deepcopy(screenParams)
+    taskParams['sequence'] = sequence
+    taskParams['peptide'] = peptide
+    taskParams['mode'] = mode
+    taskParams['workdir'] = workdir
+    taskParams['run num'] = runNum
+    taskParams['explicit run enumeration'] = True
+    taskParams['save outputs'] = False  # collected in screeningResults.csv instead
+
+    startTime = time.time()
+    outputDict = {}
+    pipeline = None
+    try:
+        pipeline = opendna(taskParams)
+        outputDict = pipeline.run()
+        status = 'complete'
+    except (Exception, SystemExit) as error:  # terminateRun() exits: record it and carry on with the rest of the library
+        status = 'failed: {}'.format(repr(error))
+
+    runDir = pipeline.workDir if pipeline is not None else ''  # empty if the mode needs no run directory, eg '2d structure'
+    return summarizeOutputs(outputDict, sequence, peptide, mode, status, (time.time() - startTime) / 3600, runDir)
+
+
+def summarizeOutputs(outputDict, sequence, peptide, mode, status, runtime, runDir):
+    """
+    reduce the outputs of one pipeline to a row of the results table
+    values of several 2D structures (and docked structures) are separated by ';'
+    :return:
+    """
+    row = {'sequence': sequence, 'peptide': peptide, 'mode': mode, 'status': status, 'runtime (h)': '%.3f' % runtime, 'workdir': runDir}
+    if '2d analysis' in outputDict:
+        if isinstance(outputDict['2d analysis'], dict):  # NUPACK
+            row['2d structure'] = ';'.join(outputDict['2d analysis']['2d string'])
+        else:  # seqfold: [ssString, pairList]
+            row['2d structure'] = outputDict['2d analysis'][0]
+
+    dockScores, bindingResults = [], {'close contact ratio': [], 'contact score': [], 'conformation change': []}
+    for key in sorted(outputDict.keys()):
+        if key.startswith('dock scores'):
+            dockScores.append('%.3f' % np.amax(outputDict[key]))  # best docking score of each 2D structure
+        elif key.startswith('binding results'):
+            for result in bindingResults.keys():
+                bindingResults[result].append('%.3f' % outputDict[key][result])
+    row['dock scores'] = ';'.join(dockScores)
+    for result in bindingResults.keys():
+        row[result] = ';'.join(bindingResults[result])
+
+    return row
+
+
+def writeResults(rows, resultsFile):
+    """
+    append rows to the results table, which may be shared by every job of a job array
+    :param rows:
+    :param resultsFile:
+    :return:
+    """
+    with fileLock(resultsFile + '.lock'):
+        newFile = not os.path.exists(resultsFile)
+        with open(resultsFile, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=resultColumns)
+            if newFile:
+                writer.writeheader()
+            writer.writerows(rows)
+
+
+def runTasks(tasks, workers):
+    """
+    run a list of pipeline tasks on a process pool
+    :param tasks: list of argument tuples for runPipelineTask
+    :param workers:
+    :return: rows of the results table, in the order of tasks
+    """
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(runPipelineTask, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def screen(screenInput):
+    """
+    run this job's chunk of the library
+    stage 1: aptamer-only stages, once per unique sequence
+    stage 2: every (sequence, peptide) pair, picking up the aptamer stages from the cache
+    :param screenInput: command line input of the screen, see get_screen_input
+    """
+    codeDir = os.getcwd()
+    screenDir = os.path.abspath(screenInput.screen_dir if screenInput.screen_dir is not None else params['workdir'] + '/screen')
+    os.makedirs(screenDir + '/aptamers', exist_ok=True)
+    os.makedirs(screenDir + '/pairs', exist_ok=True)
+    os.makedirs(params['cache dir'], exist_ok=True)
+
+    pairs = readLibrary(screenInput.library, screenInput.peptides)
+    pairIndices = np.array_split(np.arange(len(pairs)), screenInput.array_size)[screenInput.array_index]  # contiguous chunk for this job
+    printRecord('Screening {} of {} pairs in {} mode on {} workers'.format(len(pairIndices), len(pairs), params['mode'], screenInput.workers), screenDir + '/')
+
+    aptamerMode = aptamerModes.get(params['mode'], params['mode'])  # modes without docking only depend on the aptamer
+    sequences = list(dict.fromkeys([pairs[index][0] for index in pairIndices]))  # unique sequences, in library order
+    allSequences = list(dict.fromkeys([pair[0] for pair in pairs]))  # run numbers are unique across the job array
+    tasks = [(codeDir, params, sequence, 'A', aptamerMode, screenDir + '/aptamers', allSequences.index(sequence) + 1) for sequence in sequences]
+    aptamerRows = runTasks(tasks, screenInput.workers)
+
+    if params['mode'] in aptamerModes:
+        tasks = [(codeDir, params, pairs[index][0], pairs[index][1], params['mode'], screenDir + '/pairs', int(index) + 1) for index in pairIndices]
+        writeResults(runTasks(tasks, screenInput.workers), screenDir + '/screeningResults.csv')
+    else:
+        writeResults([dict(row, peptide=pairs[index][1]) for index in pairIndices for row in aptamerRows if row['sequence'] == pairs[index][0]],
+                     screenDir + '/screeningResults.csv')
+
+    printRecord('Screening complete', screenDir + '/')
+
+
+if __name__ == '__main__':
+    screen(screenInput)
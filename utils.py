@@ -11,6 +11,15 @@ import os
 import csv
 import numpy as np
 import time
+import hashlib
+import json
+import pickle
+import tempfile
+from contextlib import contextmanager
+try:
+    import fcntl  # file locks between cluster jobs - not available on windows
+except ImportError:
+    fcntl = None
 
 import Bio.PDB  # biopython
 import mdtraj as md
@@ -90,6 +99,185 @@ def printRecord(statement, filepath=""):
             file.write('\n' + statement)
 
 
+@contextmanager
+def fileLock(lockFile):
+    """
+    hold an exclusive lock on a file while working on something shared by concurrent jobs
+    no-op where fcntl is not available
+    :param lockFile:
+    :return:
+    """
+    with open(lockFile, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class resultCache:
+    """
+    on-disk, content-addressed cache of pickled results which can be shared by many runs and cluster jobs
+    entries are keyed by a hash of their inputs, and the least recently used entries are evicted beyond maxSize
+    """
+    def __init__(self, cacheDir, maxSize=1024):
+        """
+        :param cacheDir: cache directory, created if it doesn't exist
+        :param maxSize: maximum total size of the cache in MB
+        """
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize * 1e6
+        os.makedirs(self.cacheDir, exist_ok=True)
+
+    def getEntry(self, inputs):
+        """
+        cache file for a given set of inputs
+        :param inputs: tuple of everything the result depends on, eg ('nupack', sequence, temperature, ...)
+        :return:
+        """
+        return os.path.join(self.cacheDir, hashlib.sha256(repr(inputs).encode()).hexdigest() + '.pkl')
+
+    def get(self, inputs):
+        """
+        :param inputs:
+        :return: the cached result, or None if there is no such entry
+        """
+        entry = self.getEntry(inputs)
+        try:
+            with open(entry, 'rb') as f:
+                result = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):  # not cached, or evicted by another job meanwhile
+            return None
+        try:
+            os.utime(entry)  # mark as recently used
+        except FileNotFoundError:  # evicted by another job since it was read, the result is still good
+            pass
+
+        return result
+
+    def put(self, inputs, result):
+        """
+        store a result - written to a temporary file first, so other jobs only ever see complete entries
+        :param inputs:
+        :param result:
+        :return:
+        """
+        fd, tmpFile = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(tmpFile, self.getEntry(inputs))  # atomic
+        self.evict()
+
+    def evict(self):
+        """
+        remove the least recently used entries until the cache fits in maxSize
+        :return:
+        """
+        with fileLock(os.path.join(self.cacheDir, '.lock')):
+            entries = []
+            for file in os.listdir(self.cacheDir):
+                if file.endswith('.pkl'):
+                    try:
+                        stat = os.stat(os.path.join(self.cacheDir, file))
+                        entries.append((stat.st_mtime, stat.st_size, file))
+                    except FileNotFoundError:
+                        pass
+
+            cacheSize = sum([entry[1] for entry in entries])
+            for mtime, size, file in sorted(entries):  # oldest first
+                if cacheSize <= self.maxSize:
+                    break
+                try:
+                    os.remove(os.path.join(self.cacheDir, file))
+                except FileNotFoundError:
+                    pass
+                cacheSize -= size
+
+
+def getFileHash(file):
+    """
+    sha256 of a file's contents, read in chunks so large trajectories don't need to fit in memory
+    :param file:
+    :return:
+    """
+    fileHash = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            fileHash.update(chunk)
+
+    return fileHash.hexdigest()
+
+
+class stageManifest:
+    """
+    record of the completed stages of a pipeline run in a directory, to resume an interrupted run
+    stageManifest.json lists each stage with a hash of its inputs and the hashes of its output files
+    the rest of its outputs (return value, new pdbDict entries etc.) are pickled in the 'stages' sub-directory
+    """
+    def __init__(self, directory='.'):
+        self.manifestFile = os.path.join(directory, 'stageManifest.json')
+        self.stageDir = os.path.join(directory, 'stages')
+
+    def read(self):
+        if os.path.exists(self.manifestFile):
+            with open(self.manifestFile, 'r') as f:
+                return json.load(f)
+        else:
+            return {}
+
+    def get(self, stage, inputs):
+        """
+        :param stage: name of the stage, eg 'fold 0'
+        :param inputs: tuple of everything the stage depends on
+        :return: the outputs of the stage, or None if it wasn't completed with these inputs, or any of its files changed since
+        """
+        manifest = self.read()
+        entry = manifest.get(stage)
+        if (entry is None) or (entry['inputs'] != hashlib.sha256(repr(inputs).encode()).hexdigest()):
+            return None
+        fileHashes = {}
+        for stageEntry in manifest.values():  # in the order the stages were completed: a file rewritten by a later stage (eg, by prepPDB) is checked against its last version
+            for file, (fileHash, size, mtime) in stageEntry['files'].items():
+                fileHashes[file] = fileHash
+        for file in entry['files'].keys():
+            if (not os.path.exists(file)) or (getFileHash(file) != fileHashes[file]):
+                return None
+
+        with open(entry['outputs'], 'rb') as f:
+            return pickle.load(f)
+
+    def put(self, stage, inputs, outputs, files):
+        """
+        record a completed stage
+        :param stage:
+        :param inputs:
+        :param outputs: anything to restore when the stage is skipped
+        :param files: output files of the stage, including files of earlier stages which it rewrote (eg, by prepPDB)
+        :return:
+        """
+        os.makedirs(self.stageDir, exist_ok=True)
+        outputsFile = os.path.join(self.stageDir, stage.replace(' ', '_') + '.pkl')
+        with open(outputsFile, 'wb') as f:
+            pickle.dump(outputs, f)
+
+        entry = {'inputs': hashlib.sha256(repr(inputs).encode()).hexdigest(),
+                 'outputs': outputsFile,
+                 'files': {file: [getFileHash(file), os.path.getsize(file), os.path.getmtime(file)] for file in list(files) + [outputsFile]},
+                 'completed': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+        with fileLock(self.manifestFile + '.lock'):  # other processes may record their stages in the same directory
+            manifest = self.read()
+            manifest.pop(stage, None)  # a stage which was run again is the latest one
+            manifest[stage] = entry
+
+            tmpFile = self.manifestFile + '.{}.tmp'.format(os.getpid())
+            with open(tmpFile, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmpFile, self.manifestFile)  # atomic, in case the job is killed while writing
+
+
 def prepPDB(file, boxOffset, pH, ionicStrength, MMBCORRECTION=False, waterBox=True):
     """
     Soak pdb file in water box
@@ -425,13 +613,12 @@ def readFinalLines(file, lines):
     return finalLines
 
 
-def appendTrajectory(topology, original, new):
+def combineTrajectories(topology, trajectories, combinedTrajectory):
     """
-    Use mda to combine old and new MD trajectories into one nice video
+    Use mda to join several MD trajectories of the same system into one, eg, independent replicas
     """
-    trajectories = [original, new]
     u = mda.Universe(topology, trajectories)
-    with mda.Writer('combinedTraj.dcd', u.atoms.n_atoms) as W:
+    with mda.Writer(combinedTrajectory, u.atoms.n_atoms) as W:
         for ts in u.trajectory:
             W.write(u)
 